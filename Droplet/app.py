@@ -1,14 +1,36 @@
 # app.py
 import os
+import re
+import sys
 import json
 import time
+import zlib
+import gzip
+import itertools
+import queue
+import select
+import sqlite3
 import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from pathlib import Path
 
-from flask import Flask, render_template_string, jsonify, Response, request
+from flask import Flask, render_template, jsonify, Response, request
 from influxdb_client import InfluxDBClient
 from dotenv import load_dotenv
+from werkzeug.http import parse_accept_header
+
+try:
+    import numpy as np
+except ImportError:  # max_points downsampling is skipped without numpy
+    np = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # format=parquet|arrow need pyarrow
+    pa = pq = None
 
 # ===================== CONFIG =====================
 load_dotenv()
@@ -27,33 +49,198 @@ SSE_INTERVAL_MS = int(os.getenv("SSE_INTERVAL_MS", "2000"))
 INFLUX_RANGE = os.getenv("INFLUX_RANGE", "-10m")
 INFLUX_TIMEOUT_MS = int(os.getenv("INFLUX_TIMEOUT_MS", "60000"))
 
+# History from listener's ingest-time data instead of raw scans:
+#   chart  -> <MEASUREMENT>_10s rollup, valve timeline -> <MEASUREMENT>_1s rollup,
+#   events -> valve_events (last N directly, no flip detection in python).
+# Off by default: only data written by a listener with rollups/valve events has it.
+HISTORY_FROM_INGEST = os.getenv("HISTORY_FROM_INGEST", "0") == "1"
+VALVE_EVENTS_MEASUREMENT = os.getenv("VALVE_EVENTS_MEASUREMENT", "valve_events")
+
+# One InfluxDBClient per process (urllib3 pool, thread-safe) instead of a new client per query.
+# After INFLUX_RECONNECT_ERRORS consecutive failures the client is dropped and rebuilt.
+INFLUX_POOL_SIZE = int(os.getenv("INFLUX_POOL_SIZE", "16"))
+INFLUX_RECONNECT_ERRORS = int(os.getenv("INFLUX_RECONNECT_ERRORS", "3"))
+_influx = {"client": None, "created_ts": None, "errors": 0, "queries": 0, "failures": 0, "reconnects": 0,
+           "last_error": None}
+_influx_lock = threading.Lock()
+
+# History runs 3 Flux queries (chart / valve / events): "parallel" sends them at once on a
+# bounded pool (latency = slowest one), "sequential" is the old one-after-another behaviour.
+HISTORY_QUERY_MODE = os.getenv("HISTORY_QUERY_MODE", "parallel").strip().lower()
+HISTORY_QUERY_WORKERS = int(os.getenv("HISTORY_QUERY_WORKERS", "6"))
+_history_pool = ThreadPoolExecutor(max_workers=max(1, HISTORY_QUERY_WORKERS), thread_name_prefix="history")
+
+# ===== hardcoded history windows (NO ENV) =====
+HISTORY_WIN_CHART = "10s"   # chart smoothing
+HISTORY_WIN_EVENTS = "1s"   # keep valve flips
+_HISTORY_WIN_CHART_MS = 10_000
+# ==============================================
+
+# History cache per (uid, hours): keeps computed points + high-water mark, then only
+# fetches the tail newer than it. Bounded by total cached points (LRU), 0 = off.
+HISTORY_CACHE_MAX_POINTS = int(os.getenv("HISTORY_CACHE_MAX_POINTS", "300000"))
+HISTORY_CACHE_FRESH_SEC = float(os.getenv("HISTORY_CACHE_FRESH_SEC", "2"))    # younger => served as is
+HISTORY_CACHE_FULL_SEC = float(os.getenv("HISTORY_CACHE_FULL_SEC", "600"))    # full recompute at least this often
+_history_cache = OrderedDict()
+_history_cache_lock = threading.Lock()
+_history_cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "points": 0}
+
+# /api/export streaming: response chunk size and gzip=1 compression level
+EXPORT_CHUNK_BYTES = int(os.getenv("EXPORT_CHUNK_BYTES", "65536"))
+EXPORT_GZIP_LEVEL = int(os.getenv("EXPORT_GZIP_LEVEL", "6"))
+# format=parquet|arrow: rows per row group / record batch, parquet codec
+EXPORT_BATCH_ROWS = int(os.getenv("EXPORT_BATCH_ROWS", "65536"))
+EXPORT_PARQUET_COMPRESSION = os.getenv("EXPORT_PARQUET_COMPRESSION", "zstd")
+# long exports: split the range into slices (and optionally device x slice), fetched concurrently
+EXPORT_SLICE_HOURS = float(os.getenv("EXPORT_SLICE_HOURS", "6"))   # 0 = one query
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS", "4"))
+_export_pool = ThreadPoolExecutor(max_workers=max(1, EXPORT_WORKERS), thread_name_prefix="export")
+
 # Cache: prevents Influx from being hammered by multiple SSE clients/tabs
+# Single-flight: one thread refreshes, the rest wait for it or get the previous snapshot
+# (stale-while-revalidate, up to CACHE_STALE_SEC past the TTL). While someone read it within
+# CACHE_WARM_SEC, a background thread refreshes just before expiry (0 = off).
 CACHE_TTL_SEC = float(os.getenv("CACHE_TTL_SEC", "1.0"))
-_latest_cache = {"ts": 0.0, "data": None, "error": None}
-_cache_lock = threading.Lock()
+CACHE_STALE_SEC = float(os.getenv("CACHE_STALE_SEC", "5"))
+CACHE_WARM_SEC = float(os.getenv("CACHE_WARM_SEC", "5"))
+_latest_cache = {
+    "ts": 0.0, "data": None, "error": None,
+    "refreshing": False, "read_ts": 0.0, "took": 0.0, "warm_thread": None,
+}
+_latest_stats = {"refreshes": 0, "proactive": 0, "coalesced": 0, "stale_served": 0, "errors": 0}
+
+# Latest-state query: "incremental" (only data newer than the high-water mark, merged into the
+# held state; full INFLUX_RANGE scan every LATEST_FULL_SEC) or "full" (scan every refresh)
+LATEST_QUERY_MODE = os.getenv("LATEST_QUERY_MODE", "incremental").strip().lower()
+LATEST_FULL_SEC = float(os.getenv("LATEST_FULL_SEC", "60"))
+LATEST_OVERLAP_SEC = float(os.getenv("LATEST_OVERLAP_SEC", "5"))
+_latest_state = {"devices": None, "hw": None, "full_ts": 0.0, "full_queries": 0, "incremental_queries": 0}
+_latest_state_lock = threading.Lock()
+_cache_lock = threading.Condition()
+
+# SSE: one background thread builds + serialises the snapshot, all streams get the same bytes.
+# A client whose queue is full (not reading fast enough) gets disconnected.
+# Stream = one full "devices" snapshot, then "delta" events (changed/removed devices only)
+# with increasing ids; a reconnect with Last-Event-ID replays missed deltas from a small ring.
+SSE_CLIENT_QUEUE = int(os.getenv("SSE_CLIENT_QUEUE", "8"))
+SSE_KEEPALIVE_SEC = float(os.getenv("SSE_KEEPALIVE_SEC", "15"))
+SSE_DELTA_RING = int(os.getenv("SSE_DELTA_RING", "300"))
+_sse_clients = set()
+_sse_lock = threading.Lock()
+_sse_state = {
+    "thread": None,
+    "id": int(time.time() * 1000),  # start high so ids stay increasing across restarts
+    "devices": None,                # uid -> device dict as last broadcast
+    "meta": {},                     # server_time_utc / cache_age_ms / cache_error of last tick
+    "ring": deque(maxlen=max(1, SSE_DELTA_RING)),  # (id, frame)
+    "full": None,                   # (id, frame), built lazily for new subscribers
+    "stats": {"frames": 0, "disconnected_slow": 0, "full_sent": 0, "resumed": 0},
+}
+
+# Rendered /device/<uid> pages (plain + gzip), keyed by (uid, fragment path), invalidated by mtime/size
+PAGE_CACHE_MAX = int(os.getenv("PAGE_CACHE_MAX", "256"))
+_page_cache = OrderedDict()
+_page_cache_lock = threading.Lock()
+_page_cache_stats = {"hits": 0, "misses": 0}
 
 # Where listener saves init-html fragments (one file per device)
 BASE_DIR = Path(__file__).resolve().parent
 TEMPLATES_DIR = Path(os.getenv("DEVICE_TEMPLATES_DIR", str(BASE_DIR / "device_templates")))
 DEVICES_JSON_PATH = Path(os.getenv("DEVICES_JSON_PATH", str(BASE_DIR / "devices.json")))  # kept for future use
 
+# Latest device state published by listener.py (SQLite, WAL). When used, "now"
+# (/api/devices/latest, SSE, index) is read from it and Influx only serves history.
+# LATEST_SOURCE: auto (store if the file exists and the listener wrote to it lately) | store | influx
+LATEST_SOURCE = os.getenv("LATEST_SOURCE", "auto").strip().lower()
+LATEST_DB_PATH = Path(os.getenv("LATEST_DB", str(BASE_DIR / "latest_state.db")))
+LATEST_STORE_POLL_SEC = float(os.getenv("LATEST_STORE_POLL_SEC", "0.1"))  # SSE change check
+LATEST_STORE_STALE_SEC = float(os.getenv("LATEST_STORE_STALE_SEC", "300"))  # auto: older newest write => Influx
+_store = {"conn": None, "version": None, "data": None, "ts": 0.0, "exists": None, "stale": None,
+          "checked_ts": 0.0, "reads": 0, "queries": 0, "error": None}
+_store_lock = threading.Lock()
+
 app = Flask(__name__)
 
 # make sure dir exists
 TEMPLATES_DIR.mkdir(parents=True, exist_ok=True)
 
+# In-memory index of TEMPLATES_DIR (file names), so has_view is a set lookup.
+# TEMPLATES_WATCH=inotify (Linux, falls back to scan) | scan
+TEMPLATES_WATCH = os.getenv("TEMPLATES_WATCH", "inotify").strip().lower()
+TEMPLATES_SCAN_SEC = float(os.getenv("TEMPLATES_SCAN_SEC", "1.0"))      # polling interval
+TEMPLATES_RESCAN_SEC = float(os.getenv("TEMPLATES_RESCAN_SEC", "60"))   # safety rescan with inotify
+_tpl_index = {"names": frozenset(), "mode": None, "thread": None, "scans": 0, "events": 0, "scan_ts": 0.0}
+_tpl_lock = threading.Lock()
+
 
 # ===================== HELPERS =====================
 def influx_client():
+    """
+    Process-wide client. Do NOT use it as a context manager (that would close it for everyone).
+    """
     if not all([INFLUX_URL, INFLUX_TOKEN, INFLUX_ORG, INFLUX_BUCKET]):
         raise RuntimeError("InfluxDB config missing in .env")
-    return InfluxDBClient(
-        url=INFLUX_URL,
-        token=INFLUX_TOKEN,
-        org=INFLUX_ORG,
-        timeout=INFLUX_TIMEOUT_MS,
-        enable_gzip=True,
-    )
+    with _influx_lock:
+        if _influx["client"] is None:
+            _influx["client"] = InfluxDBClient(
+                url=INFLUX_URL,
+                token=INFLUX_TOKEN,
+                org=INFLUX_ORG,
+                timeout=INFLUX_TIMEOUT_MS,
+                enable_gzip=True,
+                connection_pool_maxsize=INFLUX_POOL_SIZE,
+            )
+            _influx["created_ts"] = time.time()
+        return _influx["client"]
+
+
+def _influx_result(ok: bool, error=None):
+    """
+    Book-keeping after each Influx call; rebuilds the client after repeated failures
+    (DNS change, half-dead keep-alive sockets, Influx restart behind a proxy...).
+    """
+    old = None
+    with _influx_lock:
+        _influx["queries"] += 1
+        if ok:
+            _influx["errors"] = 0
+            return
+        _influx["failures"] += 1
+        _influx["errors"] += 1
+        _influx["last_error"] = str(error)
+        if _influx["errors"] >= INFLUX_RECONNECT_ERRORS and _influx["client"] is not None:
+            old, _influx["client"] = _influx["client"], None
+            _influx["errors"] = 0
+            _influx["reconnects"] += 1
+    if old is not None:
+        try:
+            old.close()
+        except Exception:
+            pass
+
+
+def influx_pool_stats() -> dict:
+    with _influx_lock:
+        out = {k: v for k, v in _influx.items() if k != "client"}
+        client = _influx["client"]
+    out["pool_maxsize"] = INFLUX_POOL_SIZE
+    out["pools"] = []
+    if client is not None:
+        try:
+            pm = client.api_client.rest_client.pool_manager
+            for key in list(pm.pools.keys()):
+                pool = pm.pools.get(key)
+                if pool is None:
+                    continue
+                out["pools"].append({
+                    "host": f"{key.key_scheme}://{key.key_host}:{key.key_port}",
+                    "connections_created": pool.num_connections,
+                    "requests": pool.num_requests,
+                    "in_use": pool.pool.maxsize - pool.pool.qsize() if pool.pool else 0,
+                })
+        except Exception as e:
+            out["pools_error"] = str(e)
+    return out
 
 
 def utc_now():
@@ -76,12 +263,48 @@ def fmt_float(v):
 
 
 def _influx_query(query: str):
-    with influx_client() as client:
-        return client.query_api().query(query)
+    try:
+        tables = influx_client().query_api().query(query)
+    except Exception as e:
+        _influx_result(False, e)
+        raise
+    _influx_result(True)
+    return tables
+
+
+def _influx_query_stream(query: str):
+    """
+    FluxRecords one by one (query_stream): the response is parsed as it arrives,
+    never materialised as tables. The first record is fetched eagerly so that
+    connection/query errors raise here and not half-way through a response.
+    """
+    try:
+        records = influx_client().query_api().query_stream(query)
+        first = next(records, None)
+    except Exception as e:
+        _influx_result(False, e)
+        raise
+    _influx_result(True)
+    if first is None:
+        return iter(())
+    return itertools.chain((first,), records)
 
 
-def load_device_history(uid: str, hours: int = 24, limit_events: int = 50):
+def _influx_query_many(queries):
     """
+    Runs several queries, in parallel if HISTORY_QUERY_MODE == "parallel"; results in input order.
+    """
+    if HISTORY_QUERY_MODE != "parallel" or len(queries) < 2:
+        return [_influx_query(q) for q in queries]
+    futures = [_history_pool.submit(_influx_query, q) for q in queries]
+    return [f.result() for f in futures]
+
+
+def load_device_history(uid: str, hours: int = 24, limit_events: int = 50, max_points: int = 0):
+    """
+    max_points > 0: pressure_points are LTTB-downsampled to about that many points
+    (valve flip instants are always kept, see downsample_pressure()).
+
     Returns:
       {
         "uid": "...",
@@ -92,24 +315,171 @@ def load_device_history(uid: str, hours: int = 24, limit_events: int = 50):
       }
     """
 
-    # ===== hardcoded windows (NO ENV) =====
-    WIN_CHART = "10s"   # chart smoothing
-    WIN_EVENTS = "1s"   # keep valve flips
-    # =====================================
-
     # safety limits
     hours = max(1, min(int(hours), 168))                # 1h..168h
     limit_events = max(1, min(int(limit_events), 500)) # 1..500
-    range_expr = f"-{hours}h"
 
-    def norm_valve(v) -> str:
-        s = (v or "").strip().lower()
-        if s in ("lahti", "open", "opened", "on", "1", "true"):
-            return "open"
-        if s in ("kinni", "closed", "off", "0", "false"):
-            return "closed"
-        return s or "?"
+    if HISTORY_FROM_INGEST:
+        data = _load_device_history_ingest(uid, hours, limit_events)
+        return _apply_max_points(data, max_points)
+
+    now_ms = int(time.time() * 1000)
+    # range start aligned to the chart window: no window is cut by it, so trimming
+    # cached windows by their stamp gives exactly what a fresh query returns
+    head_ms = now_ms - hours * 3600 * 1000
+    head_ms -= head_ms % _HISTORY_WIN_CHART_MS
+    key = (uid, hours)
+    entry = _history_cache_get(key)
+
+    if entry is not None and now_ms - entry["refreshed_ms"] < HISTORY_CACHE_FRESH_SEC * 1000:
+        cache_status = "fresh"
+    elif entry is not None and entry["hw"] and now_ms - entry["full_ms"] < HISTORY_CACHE_FULL_SEC * 1000:
+        # tail only: re-read from one full chart window before the high-water mark.
+        # The boundary is window-aligned, so every re-read window is complete and
+        # simply replaces the cached points stamped after it.
+        tail_ms = entry["hw"] - entry["hw"] % _HISTORY_WIN_CHART_MS - _HISTORY_WIN_CHART_MS
+        older_events = [e for e in entry["events"] if e["time_ms"] <= tail_ms]
+        # valve state at the boundary from the timeline (events may already be trimmed away)
+        older_valve = [p for p in entry["valve_points"] if p["t"] <= tail_ms]
+        initial = older_valve[-1]["state"] if older_valve else None
+        older_pressure = [p for p in entry["pressure_points"] if p["t"] <= tail_ms]
+        initial_ms = older_pressure[-1]["t"] if older_pressure else tail_ms
+        tail = _query_device_history(uid, _flux_time(tail_ms), initial, initial_ms)
+
+        valve_points = []
+        for p in [p for p in entry["valve_points"] if p["t"] <= tail_ms] + tail["valve_points"]:
+            if not valve_points or valve_points[-1]["state"] != p["state"]:
+                valve_points.append(p)
+
+        entry = {
+            "pressure_points": older_pressure + tail["pressure_points"],
+            "valve_points": valve_points,
+            "events": older_events + tail["events"],
+            "hw": max(entry["hw"], tail["hw"]),
+            "full_ms": entry["full_ms"],
+            "refreshed_ms": now_ms,
+        }
+        cache_status = "hit"
+    else:
+        full = _query_device_history(uid, _flux_time(head_ms), None)
+        entry = dict(full, full_ms=now_ms, refreshed_ms=now_ms)
+        cache_status = "miss" if HISTORY_CACHE_MAX_POINTS > 0 else "off"
+
+    if cache_status != "fresh":
+        # trim head: range start moved; keep the state that was active at the new start.
+        # Windows are stamped at their end, so one stamped exactly at head_ms is outside the range.
+        vp = [p for p in entry["valve_points"] if p["t"] > head_ms]
+        before = [p for p in entry["valve_points"] if p["t"] <= head_ms]
+        if before:
+            vp.insert(0, {"t": head_ms, "state": before[-1]["state"]})
+        entry["valve_points"] = vp
+        entry["pressure_points"] = [p for p in entry["pressure_points"] if p["t"] > head_ms]
+        # a flip whose previous record fell out of the range is now the first record:
+        # a full load would only take the state from it
+        entry["events"] = [e for e in entry["events"] if e["prev_ms"] > head_ms][-500:]
+        _history_cache_put(key, entry)
+
+    pressure_points = entry["pressure_points"]
+    valve_points = entry["valve_points"]
+
+    # keep last N events, newest first (prev_ms is cache bookkeeping)
+    events = [{k: v for k, v in e.items() if k != "prev_ms"} for e in reversed(entry["events"][-limit_events:])]
+
+    return _apply_max_points({
+        "uid": uid,
+        "hours": hours,
+        "pressure_points": pressure_points,
+        "valve_points": valve_points,
+        "events": events,
+        "counts": {
+            "pressure_points": len(pressure_points),
+            "valve_points": len(valve_points),
+            "events": len(events),
+            "win_events": HISTORY_WIN_EVENTS,
+            "win_chart": HISTORY_WIN_CHART,
+            "source": "raw",
+            "query_mode": HISTORY_QUERY_MODE,
+            "cache": cache_status,
+        }
+    }, max_points)
+
+
+def _apply_max_points(data: dict, max_points: int) -> dict:
+    # downsample a fresh list: the cache keeps the full-resolution series
+    if max_points and max_points > 0:
+        pts = downsample_pressure(data["pressure_points"], max_points, [p["t"] for p in data["valve_points"]])
+        data["counts"]["pressure_points_raw"] = len(data["pressure_points"])
+        data["counts"]["pressure_points"] = len(pts)
+        data["counts"]["max_points"] = max_points
+        data["pressure_points"] = pts
+    return data
+
 
+def _lttb_indices(t, v, n: int):
+    """
+    Largest-Triangle-Three-Buckets: indices of n points that keep the visual shape.
+    First and last points are always kept; per bucket the triangle areas are numpy-vectorised.
+    """
+    size = len(t)
+    if n >= size or n < 3:
+        return np.arange(size)
+    edges = np.linspace(1, size - 1, n - 1).astype(np.int64)  # n-2 buckets over t[1:-1]
+    out = np.empty(n, dtype=np.int64)
+    out[0], out[-1] = 0, size - 1
+    a = 0
+    for i in range(n - 2):
+        lo, hi = edges[i], max(edges[i + 1], edges[i] + 1)
+        # next bucket average (the last point for the final bucket)
+        nlo, nhi = hi, (edges[i + 2] if i + 2 < n - 1 else size)
+        nhi = max(nhi, nlo + 1)
+        cx, cy = t[nlo:nhi].mean(), v[nlo:nhi].mean()
+        ax, ay = t[a], v[a]
+        area = np.abs((ax - cx) * (v[lo:hi] - ay) - (ax - t[lo:hi]) * (cy - ay))
+        a = lo + int(area.argmax())
+        out[i + 1] = a
+    return out
+
+
+def downsample_pressure(points: list, max_points: int, keep_t: list) -> list:
+    """
+    LTTB down to at most max_points; the samples around every time in keep_t (valve
+    flips) are always kept, so a flip never lands between two far-apart samples.
+    They come out of the same budget (only more flips than max_points allows exceed it).
+    """
+    if np is None or max_points <= 0 or len(points) <= max_points:
+        return points
+    t = np.fromiter((p["t"] for p in points), dtype=np.float64, count=len(points))
+    v = np.fromiter((p["v"] for p in points), dtype=np.float64, count=len(points))
+    keep = np.empty(0, dtype=np.int64)
+    if keep_t:
+        pos = np.searchsorted(t, np.asarray(keep_t, dtype=np.float64))
+        around = np.concatenate([pos - 1, pos])
+        keep = np.unique(around[(around >= 0) & (around < len(points))])
+    idx = np.union1d(_lttb_indices(t, v, max(3, max_points - len(keep))), keep)
+    return [points[i] for i in idx.tolist()]
+
+
+def norm_valve(v) -> str:
+    s = (v or "").strip().lower()
+    if s in ("lahti", "open", "opened", "on", "1", "true"):
+        return "open"
+    if s in ("kinni", "closed", "off", "0", "false"):
+        return "closed"
+    return s or "?"
+
+
+def _flux_time(ms: int) -> str:
+    # RFC3339 literal usable directly as range(start: ...)
+    return datetime.fromtimestamp(ms / 1000, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def _query_device_history(uid: str, range_expr: str, initial_state, initial_ms: int = 0):
+    """
+    Raw-data history from range_expr (e.g. "-24h" or an RFC3339 time) to now.
+    Events are chronological; initial_state is the valve state just before range start
+    (None => the first window only sets the state, as on a full load), initial_ms is
+    about when it was last seen. Each event carries prev_ms, the previous record time.
+    """
     # 1) pressure_now series for chart
     # (group OK here, because we only need _time/_value)
     q_pressure = f"""
@@ -120,7 +490,7 @@ from(bucket: "{INFLUX_BUCKET}")
   |> filter(fn: (r) => r.device_id == "{uid}")
   |> filter(fn: (r) => r._field == "pressure_now")
   |> group(columns: ["device_id","_field"])
-  |> aggregateWindow(every: {WIN_CHART}, fn: last, createEmpty: false)
+  |> aggregateWindow(every: {HISTORY_WIN_CHART}, fn: last, createEmpty: false)
   |> keep(columns: ["_time","_value"])
   |> sort(columns: ["_time"], desc: false)
 """
@@ -133,7 +503,7 @@ from(bucket: "{INFLUX_BUCKET}")
   |> filter(fn: (r) => r.team == "{TEAM_FILTER}")
   |> filter(fn: (r) => r.device_id == "{uid}")
   |> filter(fn: (r) => r._field == "pressure_now")
-  |> aggregateWindow(every: {WIN_EVENTS}, fn: last, createEmpty: false)
+  |> aggregateWindow(every: {HISTORY_WIN_EVENTS}, fn: last, createEmpty: false)
   |> keep(columns: ["_time","valve_state"])
   |> sort(columns: ["_time"], desc: false)
 """
@@ -148,15 +518,18 @@ from(bucket: "{INFLUX_BUCKET}")
   |> filter(fn: (r) => r.team == "{TEAM_FILTER}")
   |> filter(fn: (r) => r.device_id == "{uid}")
   |> filter(fn: (r) => r._field == "pressure_now" or r._field == "pressure_prev" or r._field == "pressure_30ms_ago")
-  |> aggregateWindow(every: {WIN_EVENTS}, fn: last, createEmpty: false)
+  |> aggregateWindow(every: {HISTORY_WIN_EVENTS}, fn: last, createEmpty: false)
   |> keep(columns: ["_time","_field","_value","valve_state"])
   |> pivot(rowKey: ["_time","valve_state"], columnKey: ["_field"], valueColumn: "_value")
   |> sort(columns: ["_time"], desc: false)
 """
 
     # ---- execute ----
+    res_pressure, res_valve, res_events = _influx_query_many([q_pressure, q_valve, q_events])
+    hw = 0  # newest timestamp seen in any result (for the incremental cache)
+
     pressure_points = []
-    for t in _influx_query(q_pressure):
+    for t in res_pressure:
         for r in t.records:
             ts = r.get_time()
             if not ts:
@@ -165,17 +538,19 @@ from(bucket: "{INFLUX_BUCKET}")
             if v is None:
                 continue
             t_ms = int(ts.astimezone(timezone.utc).timestamp() * 1000)
+            hw = max(hw, t_ms)
             pressure_points.append({"t": t_ms, "v": v})
 
     # valve timeline points
     valve_points = []
-    for t in _influx_query(q_valve):
+    for t in res_valve:
         for r in t.records:
             ts = r.get_time()
             if not ts:
                 continue
             st = norm_valve(r.values.get("valve_state"))
             t_ms = int(ts.astimezone(timezone.utc).timestamp() * 1000)
+            hw = max(hw, t_ms)
             valve_points.append({"t": t_ms, "state": st})
 
     # dedupe consecutive states (so timeline segments make sense)
@@ -187,20 +562,25 @@ from(bucket: "{INFLUX_BUCKET}")
             last = p["state"]
     valve_points = vp
 
-    # events: ONLY flips
+    # events: ONLY flips. The first window of a full load only sets the state (no flip
+    # can be seen there); on a tail fetch last_state carries over from the cached part.
     events = []
-    last_state = None
+    last_state = initial_state
+    last_ms = initial_ms
 
-    for t in _influx_query(q_events):
+    for t in res_events:
         for r in t.records:
             ts = r.get_time()
             if not ts:
                 continue
 
             st = norm_valve(r.values.get("valve_state"))
+            t_utc = ts.astimezone(timezone.utc)
+            prev_ms, last_ms = last_ms, int(t_utc.timestamp() * 1000)
 
             # keep only flips
-            if last_state is not None and st == last_state:
+            if last_state is None or st == last_state:
+                last_state = st
                 continue
             last_state = st
 
@@ -214,20 +594,150 @@ from(bucket: "{INFLUX_BUCKET}")
             if p_now is not None and p_prev is not None:
                 delta = p_now - p_prev
 
-            t_utc = ts.astimezone(timezone.utc)
+            hw = max(hw, last_ms)
             events.append({
-                "time_ms": int(t_utc.timestamp() * 1000),
+                "time_ms": last_ms,
                 "time_hm": t_utc.strftime("%H:%M:%S"),
                 "valve_state": st,
                 "pressure_prev": p_prev,
                 "pressure_now": p_now,
-                "delta": delta
+                "delta": delta,
+                "prev_ms": prev_ms,
             })
 
-    # keep last N events, newest first
-    if len(events) > limit_events:
-        events = events[-limit_events:]
-    events = list(reversed(events))
+    return {
+        "pressure_points": pressure_points,
+        "valve_points": valve_points,
+        "events": events,
+        "hw": hw,
+    }
+
+
+# ===================== HISTORY CACHE =====================
+def _history_entry_size(e) -> int:
+    return len(e["pressure_points"]) + len(e["valve_points"]) + len(e["events"])
+
+
+def _history_cache_get(key):
+    if HISTORY_CACHE_MAX_POINTS <= 0:
+        return None
+    with _history_cache_lock:
+        e = _history_cache.get(key)
+        if e is None:
+            _history_cache_stats["misses"] += 1
+            return None
+        _history_cache.move_to_end(key)
+        _history_cache_stats["hits"] += 1
+        return e
+
+
+def _history_cache_put(key, entry):
+    if HISTORY_CACHE_MAX_POINTS <= 0:
+        return
+    size = _history_entry_size(entry)
+    with _history_cache_lock:
+        old = _history_cache.pop(key, None)
+        if old is not None:
+            _history_cache_stats["points"] -= _history_entry_size(old)
+        if size > HISTORY_CACHE_MAX_POINTS:
+            return
+        _history_cache[key] = entry
+        _history_cache_stats["points"] += size
+        while _history_cache_stats["points"] > HISTORY_CACHE_MAX_POINTS:
+            _, ev = _history_cache.popitem(last=False)
+            _history_cache_stats["points"] -= _history_entry_size(ev)
+            _history_cache_stats["evictions"] += 1
+
+
+def history_cache_stats() -> dict:
+    with _history_cache_lock:
+        return {"entries": len(_history_cache), "max_points": HISTORY_CACHE_MAX_POINTS, **_history_cache_stats}
+
+
+def _load_device_history_ingest(uid: str, hours: int, limit_events: int):
+    """
+    Same result shape as load_device_history(), read from listener rollups / valve_events.
+    """
+    range_expr = f"-{hours}h"
+
+    q_pressure = f"""
+from(bucket: "{INFLUX_BUCKET}")
+  |> range(start: {range_expr})
+  |> filter(fn: (r) => r._measurement == "{MEASUREMENT}_10s")
+  |> filter(fn: (r) => r.team == "{TEAM_FILTER}")
+  |> filter(fn: (r) => r.device_id == "{uid}")
+  |> filter(fn: (r) => r._field == "pressure_now")
+  |> group(columns: ["device_id","_field"])
+  |> keep(columns: ["_time","_value"])
+  |> sort(columns: ["_time"], desc: false)
+"""
+
+    # rollup keeps valve_state as tag => one table per state; glue before sort
+    q_valve = f"""
+from(bucket: "{INFLUX_BUCKET}")
+  |> range(start: {range_expr})
+  |> filter(fn: (r) => r._measurement == "{MEASUREMENT}_1s")
+  |> filter(fn: (r) => r.team == "{TEAM_FILTER}")
+  |> filter(fn: (r) => r.device_id == "{uid}")
+  |> filter(fn: (r) => r._field == "pressure_now")
+  |> keep(columns: ["_time","valve_state"])
+  |> group()
+  |> sort(columns: ["_time"], desc: false)
+"""
+
+    q_events = f"""
+from(bucket: "{INFLUX_BUCKET}")
+  |> range(start: {range_expr})
+  |> filter(fn: (r) => r._measurement == "{VALVE_EVENTS_MEASUREMENT}")
+  |> filter(fn: (r) => r.team == "{TEAM_FILTER}")
+  |> filter(fn: (r) => r.device_id == "{uid}")
+  |> keep(columns: ["_time","_field","_value","valve_state"])
+  |> pivot(rowKey: ["_time","valve_state"], columnKey: ["_field"], valueColumn: "_value")
+  |> group()
+  |> sort(columns: ["_time"], desc: true)
+  |> limit(n: {limit_events})
+"""
+
+    res_pressure, res_valve, res_events = _influx_query_many([q_pressure, q_valve, q_events])
+
+    pressure_points = []
+    for t in res_pressure:
+        for r in t.records:
+            ts = r.get_time()
+            v = fmt_float(r.get_value())
+            if not ts or v is None:
+                continue
+            pressure_points.append({"t": int(ts.astimezone(timezone.utc).timestamp() * 1000), "v": v})
+
+    valve_points = []
+    last = None
+    for t in res_valve:
+        for r in t.records:
+            ts = r.get_time()
+            if not ts:
+                continue
+            st = norm_valve(r.values.get("valve_state"))
+            if st == last:
+                continue
+            last = st
+            valve_points.append({"t": int(ts.astimezone(timezone.utc).timestamp() * 1000), "state": st})
+
+    # already newest first
+    events = []
+    for t in res_events:
+        for r in t.records:
+            ts = r.get_time()
+            if not ts:
+                continue
+            t_utc = ts.astimezone(timezone.utc)
+            events.append({
+                "time_ms": int(t_utc.timestamp() * 1000),
+                "time_hm": t_utc.strftime("%H:%M:%S"),
+                "valve_state": norm_valve(r.values.get("valve_state")),
+                "pressure_prev": fmt_float(r.values.get("pressure_prev")),
+                "pressure_now": fmt_float(r.values.get("pressure_now")),
+                "delta": fmt_float(r.values.get("delta")),
+            })
 
     return {
         "uid": uid,
@@ -239,8 +749,11 @@ from(bucket: "{INFLUX_BUCKET}")
             "pressure_points": len(pressure_points),
             "valve_points": len(valve_points),
             "events": len(events),
-            "win_events": WIN_EVENTS,
-            "win_chart": WIN_CHART,
+            "win_events": "exact",
+            "win_chart": "10s",
+            "source": "ingest",
+            "query_mode": HISTORY_QUERY_MODE,
+            "cache": "off",
         }
     }
 
@@ -261,7 +774,92 @@ def template_path_for(uid: str) -> Path:
 
 
 def has_init_template(uid: str) -> bool:
-    return template_path_for(uid).exists()
+    # set lookup in the TEMPLATES_DIR index (no syscall per device)
+    _ensure_template_watcher()
+    return template_path_for(uid).name in _tpl_index["names"]
+
+
+def _scan_templates():
+    try:
+        names = frozenset(e.name for e in os.scandir(TEMPLATES_DIR) if e.name.endswith(".html"))
+    except OSError:
+        names = frozenset()
+    _tpl_index["names"] = names  # swapped as a whole, readers need no lock
+    _tpl_index["scans"] += 1
+    _tpl_index["scan_ts"] = time.time()
+
+
+def _ensure_template_watcher():
+    if _tpl_index["thread"] is not None:
+        return
+    with _tpl_lock:
+        if _tpl_index["thread"] is None:
+            _scan_templates()
+            t = threading.Thread(target=_template_watcher, daemon=True)
+            _tpl_index["thread"] = t
+            t.start()
+
+
+def _inotify_open():
+    """
+    inotify fd watching TEMPLATES_DIR (Linux, via libc), or None -> polling.
+    """
+    if TEMPLATES_WATCH != "inotify" or not sys.platform.startswith("linux"):
+        return None
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return None
+        # IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+        mask = 0x008 | 0x040 | 0x080 | 0x100 | 0x200 | 0x400 | 0x800
+        if libc.inotify_add_watch(fd, os.fsencode(str(TEMPLATES_DIR)), mask) < 0:
+            os.close(fd)
+            return None
+        return fd
+    except Exception:
+        return None
+
+
+def _template_watcher():
+    """
+    Keeps _tpl_index fresh: rescans on inotify events (listener saves via tmp + rename),
+    otherwise every TEMPLATES_SCAN_SEC. With inotify a full rescan still runs every
+    TEMPLATES_RESCAN_SEC in case an event was missed (queue overflow, dir re-created).
+    """
+    fd = _inotify_open()
+    _tpl_index["mode"] = "inotify" if fd is not None else "scan"
+    while True:
+        if fd is None:
+            time.sleep(max(0.1, TEMPLATES_SCAN_SEC))
+            _scan_templates()
+            continue
+
+        ready, _, _ = select.select([fd], [], [], max(1.0, TEMPLATES_RESCAN_SEC))
+        if ready:
+            try:
+                while os.read(fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+            except OSError:
+                os.close(fd)
+                fd = None
+                _tpl_index["mode"] = "scan"
+            time.sleep(0.05)  # let a burst of saves settle into one rescan
+            _tpl_index["events"] += 1
+        _scan_templates()
+
+
+def template_index_stats() -> dict:
+    return {
+        "mode": _tpl_index["mode"],
+        "templates": len(_tpl_index["names"]),
+        "scans": _tpl_index["scans"],
+        "events": _tpl_index["events"],
+        "scan_age_ms": int((time.time() - _tpl_index["scan_ts"]) * 1000) if _tpl_index["scan_ts"] else None,
+    }
 
 
 def _load_latest_devices_from_influx():
@@ -269,51 +867,102 @@ def _load_latest_devices_from_influx():
     FIX:
       valve_state is a TAG => open/closed creates different series.
       last() works per-series, so we must group by device_id+_field to glue.
+
+    LATEST_QUERY_MODE=incremental: keeps the per-device state between calls and only asks
+    for points newer than the high-water mark (minus LATEST_OVERLAP_SEC for late writes);
+    a full INFLUX_RANGE scan still runs every LATEST_FULL_SEC to reconcile (lagging
+    device clocks, deleted data, devices leaving the range).
     """
+    now = time.time()
+    with _latest_state_lock:
+        devices = _latest_state["devices"]
+        hw = _latest_state["hw"]
+        full = (
+            LATEST_QUERY_MODE != "incremental"
+            or devices is None
+            or hw is None
+            or now - _latest_state["full_ts"] >= LATEST_FULL_SEC
+        )
+        devices = {} if full else {uid: dict(d, _ft=dict(d["_ft"])) for uid, d in devices.items()}
+
+    range_expr = INFLUX_RANGE if full else _flux_time(int((hw - LATEST_OVERLAP_SEC) * 1000))
     query = f"""
 from(bucket: "{INFLUX_BUCKET}")
-  |> range(start: {INFLUX_RANGE})
+  |> range(start: {range_expr})
   |> filter(fn: (r) => r._measurement == "{MEASUREMENT}")
   |> filter(fn: (r) => r.team == "{TEAM_FILTER}")
   |> group(columns: ["device_id","_field"])      // FIX: glue open/closed series
   |> last()
 """
 
-    devices = {}
+    _merge_latest_records(devices, _influx_query(query))
 
-    with influx_client() as client:
-        tables = client.query_api().query(query)
-        for table in tables:
-            for r in table.records:
-                uid = r.values.get("device_id")
-                if not uid:
-                    continue
+    # device timestamps come from the device clock: never let one running ahead move hw into the future
+    times = [d["_time"].timestamp() for d in devices.values() if d["_time"]]
+    new_hw = min(max(times), now) if times else hw
+    if not full and _INFLUX_RANGE_SEC:
+        devices = {uid: d for uid, d in devices.items() if d["_time"] and d["_time"].timestamp() >= now - _INFLUX_RANGE_SEC}
 
-                dev = devices.setdefault(uid, {
-                    "device_id": uid,
-                    "valve_state": r.values.get("valve_state"),
-                    "pressure_now": None,
-                    "pressure_prev": None,
-                    "delta": None,
-                    "_time": None,
-                })
+    with _latest_state_lock:
+        _latest_state["devices"] = devices
+        _latest_state["hw"] = new_hw
+        if full:
+            _latest_state["full_ts"] = now
+            _latest_state["full_queries"] += 1
+        else:
+            _latest_state["incremental_queries"] += 1
+
+    return _latest_device_list(devices)
 
-                ts = r.get_time()
-                if ts and (dev["_time"] is None or ts > dev["_time"]):
-                    dev["_time"] = ts
-                    dev["valve_state"] = r.values.get("valve_state")
 
-                if r.get_field() == "pressure_now":
-                    dev["pressure_now"] = fmt_float(r.get_value())
-                elif r.get_field() in ("pressure_prev", "pressure_30ms_ago"):
-                    dev["pressure_prev"] = fmt_float(r.get_value())
+def _merge_latest_records(devices: dict, tables):
+    # per-field timestamps (_ft) => a merge only ever moves a field forward in time
+    for table in tables:
+        for r in table.records:
+            uid = r.values.get("device_id")
+            if not uid:
+                continue
+
+            dev = devices.setdefault(uid, {
+                "device_id": uid,
+                "valve_state": r.values.get("valve_state"),
+                "pressure_now": None,
+                "pressure_prev": None,
+                "_time": None,
+                "_ft": {},
+            })
+
+            ts = r.get_time()
+            if ts and (dev["_time"] is None or ts > dev["_time"]):
+                dev["_time"] = ts
+                dev["valve_state"] = r.values.get("valve_state")
+
+            field = r.get_field()
+            key = "pressure_now" if field == "pressure_now" else (
+                "pressure_prev" if field in ("pressure_prev", "pressure_30ms_ago") else None
+            )
+            if key is None:
+                continue
+            seen = dev["_ft"].get(key)
+            if seen is None or ts is None or ts >= seen:
+                dev[key] = fmt_float(r.get_value())
+                dev["_ft"][key] = ts
 
+
+def _latest_device_list(devices: dict):
     out = []
-    for d in devices.values():
+    for src in devices.values():
+        d = {
+            "device_id": src["device_id"],
+            "valve_state": src["valve_state"],
+            "pressure_now": src["pressure_now"],
+            "pressure_prev": src["pressure_prev"],
+            "delta": None,
+        }
         if d["pressure_now"] is not None and d["pressure_prev"] is not None:
             d["delta"] = d["pressure_now"] - d["pressure_prev"]
 
-        t = d.get("_time")
+        t = src["_time"]
         d["offline"] = is_offline(t)
 
         if t:
@@ -326,67 +975,370 @@ from(bucket: "{INFLUX_BUCKET}")
 
         d["has_view"] = has_init_template(d["device_id"])
 
-        d.pop("_time", None)
         out.append(d)
 
     return sorted(out, key=lambda x: x["device_id"])
 
 
+def _range_seconds(expr: str):
+    # "-10m" -> 600; None if it is not a plain relative duration
+    m = re.fullmatch(r"\s*-(\d+)([smhd])\s*", expr or "")
+    if not m:
+        return None
+    return int(m.group(1)) * {"s": 1, "m": 60, "h": 3600, "d": 86400}[m.group(2)]
+
+
+_INFLUX_RANGE_SEC = _range_seconds(INFLUX_RANGE)
+
+
 def load_latest_devices():
-    now = time.time()
+    if _use_latest_store():
+        try:
+            return _load_latest_devices_from_store()
+        except Exception as e:
+            with _store_lock:
+                _store["error"] = str(e)
+            if LATEST_SOURCE == "store":
+                raise
+            # auto: fall through to Influx
 
     with _cache_lock:
-        if _latest_cache["data"] is not None and (now - _latest_cache["ts"]) < CACHE_TTL_SEC:
-            return _latest_cache["data"]
+        now = time.time()
+        _latest_cache["read_ts"] = now
+        _ensure_latest_warmer()
+
+        data = _latest_cache["data"]
+        age = now - _latest_cache["ts"]
+        if data is not None and age < CACHE_TTL_SEC:
+            return data
+
+        if data is not None and age < CACHE_TTL_SEC + CACHE_STALE_SEC:
+            # expired but recent: answer now, at most one refresh in the background
+            _latest_stats["stale_served"] += 1
+            if _latest_cache["refreshing"]:
+                _latest_stats["coalesced"] += 1
+            else:
+                _latest_cache["refreshing"] = True
+                threading.Thread(target=_refresh_latest_quietly, daemon=True).start()
+            return data
+
+        if _latest_cache["refreshing"]:
+            # nothing usable yet: wait for the query that is already running
+            _latest_stats["coalesced"] += 1
+            deadline = now + INFLUX_TIMEOUT_MS / 1000.0
+            while _latest_cache["refreshing"] and time.time() < deadline:
+                _cache_lock.wait(timeout=max(0.01, deadline - time.time()))
+            if _latest_cache["data"] is not None:
+                return _latest_cache["data"]
+            raise RuntimeError(_latest_cache["error"] or "latest devices refresh timed out")
+
+        _latest_cache["refreshing"] = True
+
+    return _refresh_latest_devices()
 
+
+def _use_latest_store() -> bool:
+    if LATEST_SOURCE == "influx":
+        return False
+    if LATEST_SOURCE == "store":
+        return True
+    now = time.time()
+    with _store_lock:
+        if now - _store["checked_ts"] >= 1.0:
+            _store["exists"] = LATEST_DB_PATH.exists()
+            _store["stale"] = _store["exists"] and _store_is_stale(now)
+            _store["checked_ts"] = now
+        return _store["exists"] and not _store["stale"]
+
+
+def _store_is_stale(now: float) -> bool:
+    # under _store_lock; a file left behind by a stopped listener must not hide the fleet
+    try:
+        newest = _store_conn().execute("SELECT max(updated_ms) FROM latest_state").fetchone()[0]
+    except sqlite3.Error as e:
+        if _store["conn"] is not None:
+            _store["conn"].close()
+        _store["conn"] = None
+        _store["error"] = str(e)
+        return True
+    return newest is None or now * 1000 - newest > LATEST_STORE_STALE_SEC * 1000
+
+
+def _store_conn():
+    # under _store_lock; read-only, the listener is the only writer
+    if _store["conn"] is None:
+        conn = sqlite3.connect(f"file:{LATEST_DB_PATH}?mode=ro", uri=True, check_same_thread=False, timeout=1.0)
+        conn.execute("PRAGMA query_only = ON")
+        _store["conn"] = conn
+    return _store["conn"]
+
+
+def _store_version():
+    # PRAGMA data_version changes whenever another connection (the listener) commits
+    with _store_lock:
+        try:
+            return _store_conn().execute("PRAGMA data_version").fetchone()[0]
+        except sqlite3.Error:
+            return None
+
+
+def _load_latest_devices_from_store():
+    """
+    Same rows as _load_latest_devices_from_influx(), from the listener's latest_state table.
+    Only re-queried when the file changed (data_version) or to refresh the offline flags.
+    """
+    now = time.time()
+    with _store_lock:
+        _store["reads"] += 1
+        try:
+            conn = _store_conn()
+            version = conn.execute("PRAGMA data_version").fetchone()[0]
+            if _store["data"] is not None and version == _store["version"] and now - _store["ts"] < 1.0:
+                return _store["data"]
+            min_ts = int((now - _INFLUX_RANGE_SEC) * 1000) if _INFLUX_RANGE_SEC else 0
+            rows = conn.execute(
+                "SELECT device_id, valve_state, pressure_now, pressure_prev, ts_ms"
+                " FROM latest_state WHERE team = ? AND ts_ms >= ? ORDER BY device_id",
+                (TEAM_FILTER, min_ts),
+            ).fetchall()
+        except sqlite3.Error:
+            # listener re-created the file, etc.: reopen next time
+            if _store["conn"] is not None:
+                _store["conn"].close()
+            _store["conn"] = None
+            raise
+        _store["queries"] += 1
+
+    devices = {
+        uid: {
+            "device_id": uid,
+            "valve_state": valve_state,
+            "pressure_now": p_now,
+            "pressure_prev": p_prev,
+            "_time": datetime.fromtimestamp(ts_ms / 1000, tz=timezone.utc),
+        }
+        for uid, valve_state, p_now, p_prev, ts_ms in rows
+    }
+    data = _latest_device_list(devices)
+    with _store_lock:
+        _store["version"] = version
+        _store["data"] = data
+        _store["ts"] = now
+        _store["error"] = None
+    return data
+
+
+def latest_store_wait(timeout: float):
+    """
+    Blocks until the listener commits new state or timeout (polls data_version,
+    one cheap pragma per LATEST_STORE_POLL_SEC). Returns immediately when the store is off.
+    """
+    if not _use_latest_store():
+        time.sleep(timeout)
+        return
+    start = _store_version()
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        time.sleep(max(0.01, min(LATEST_STORE_POLL_SEC, deadline - time.time())))
+        if _store_version() != start:
+            return
+
+
+def latest_store_stats() -> dict:
+    with _store_lock:
+        return {
+            "source": LATEST_SOURCE,
+            "path": str(LATEST_DB_PATH),
+            "active": bool(_store["exists"] and not _store["stale"]) if LATEST_SOURCE == "auto" else LATEST_SOURCE == "store",
+            "stale": _store["stale"],
+            "reads": _store["reads"],
+            "queries": _store["queries"],
+            "age_ms": int((time.time() - _store["ts"]) * 1000) if _store["ts"] else None,
+            "error": _store["error"],
+        }
+
+
+def _refresh_latest_devices():
+    # caller has set _latest_cache["refreshing"]; exactly one of these runs at a time
+    t0 = time.time()
     try:
         data = _load_latest_devices_from_influx()
-        with _cache_lock:
-            _latest_cache["ts"] = now
-            _latest_cache["data"] = data
-            _latest_cache["error"] = None
-        return data
     except Exception as e:
         with _cache_lock:
             _latest_cache["error"] = str(e)
+            _latest_cache["refreshing"] = False
+            _latest_stats["errors"] += 1
+            _cache_lock.notify_all()
             if _latest_cache["data"] is not None:
                 return _latest_cache["data"]
         raise
 
+    with _cache_lock:
+        _latest_cache["ts"] = t0
+        _latest_cache["data"] = data
+        _latest_cache["error"] = None
+        _latest_cache["took"] = time.time() - t0
+        _latest_cache["refreshing"] = False
+        _latest_stats["refreshes"] += 1
+        _cache_lock.notify_all()
+    return data
+
+
+def _refresh_latest_quietly() -> bool:
+    try:
+        _refresh_latest_devices()
+    except Exception:
+        return False
+    with _cache_lock:
+        return _latest_cache["error"] is None
+
+
+def _ensure_latest_warmer():
+    # under _cache_lock
+    if CACHE_WARM_SEC <= 0:
+        return
+    t = _latest_cache["warm_thread"]
+    if t is None or not t.is_alive():
+        t = threading.Thread(target=_latest_warmer, daemon=True)
+        _latest_cache["warm_thread"] = t
+        t.start()
+
+
+def _latest_warmer():
+    """
+    Refreshes the snapshot so it is ready when the TTL runs out: starts one
+    query duration (+50ms) before expiry. Exits after CACHE_WARM_SEC without readers.
+    """
+    while True:
+        with _cache_lock:
+            now = time.time()
+            if now - _latest_cache["read_ts"] > CACHE_WARM_SEC:
+                _latest_cache["warm_thread"] = None
+                return
+            due = _latest_cache["ts"] + CACHE_TTL_SEC - _latest_cache["took"] - 0.05
+            start = not _latest_cache["refreshing"] and now >= due
+            if start:
+                _latest_cache["refreshing"] = True
+                _latest_stats["proactive"] += 1
+
+        if start:
+            if not _refresh_latest_quietly():
+                time.sleep(max(CACHE_TTL_SEC, 0.5))  # Influx down: don't spin
+        else:
+            time.sleep(min(max(due - now, 0.01), max(CACHE_TTL_SEC / 4, 0.05)))
+
+
+def latest_cache_stats() -> dict:
+    with _cache_lock:
+        ts = _latest_cache["ts"]
+        return {
+            "age_ms": int((time.time() - ts) * 1000) if ts else None,
+            "last_query_ms": int(_latest_cache["took"] * 1000),
+            "refreshing": _latest_cache["refreshing"],
+            "warm": _latest_cache["warm_thread"] is not None,
+            "error": _latest_cache["error"],
+            **_latest_stats,
+            "query_mode": LATEST_QUERY_MODE,
+            "full_queries": _latest_state["full_queries"],
+            "incremental_queries": _latest_state["incremental_queries"],
+        }
+
 
 # ===================== ROUTES =====================
 @app.get("/api/device/<uid>/history")
 def api_device_history(uid: str):
-    hours = int(request.args.get("hours", "24"))
-    limit = int(request.args.get("limit", "50"))
-    data = load_device_history(uid, hours=hours, limit_events=limit)
+    try:
+        hours = int(request.args.get("hours", "24"))
+        limit = int(request.args.get("limit", "50"))
+        max_points = int(request.args.get("max_points", request.args.get("width", "0")))
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    data = load_device_history(uid, hours=hours, limit_events=limit, max_points=max_points)
     return jsonify(data)
 
 
 @app.get("/api/export")
 def api_export():
     """
-    Download CSV/JSON of time range.
+    Download CSV/NDJSON/JSON of time range, streamed (constant memory).
     Query:
-      uid=... (optional)
+      uid=... (optional, comma separated for several devices)
       hours=24 (optional, default 24)
-      format=csv|json (default csv)
-      limit=5000 (optional)
+      format=csv|ndjson|json|parquet|arrow (default csv; parquet/arrow need pyarrow)
+      limit=... (optional, default: everything in range)
+      gzip=1 (optional, compressed on the fly -> export.<fmt>.gz; text formats only)
+      partition=time|device (optional; device => one query per device x time slice, needs uid)
+    """
+    try:
+        body, mimetype, headers = build_export(request.args)
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    return Response(body, mimetype=mimetype, headers=headers)
+
+
+EXPORT_FIELDS = [
+    "device_id", "timestamp", "timestamp_ms", "valve_state",
+    "pressure_30ms_ago", "pressure_now", "pressure_delta"
+]
+
+
+def build_export(args):
+    """
+    Export body for /api/export; args is any mapping with .get() (Flask / Starlette query args).
+    Returns (body, mimetype, headers); body is a generator of bytes chunks.
+    The query is started here, so Influx/config errors still raise before headers go out.
     """
-    uid = request.args.get("uid")
-    hours = int(request.args.get("hours", "24"))
-    fmt = (request.args.get("format", "csv") or "csv").lower()
-    limit = int(request.args.get("limit", "5000"))
+    uids = [u.strip() for u in (args.get("uid") or "").split(",") if u.strip()]
+    hours = int(args.get("hours", "24"))
+    fmt = (args.get("format", "csv") or "csv").lower()
+    limit = int(args.get("limit", "0"))
+    gz = (args.get("gzip") or "0").lower() in ("1", "true", "yes")
 
     hours = max(1, min(hours, 168))
-    limit = max(1, min(limit, 50000))
+    if fmt in ("parquet", "arrow"):
+        if pa is None:
+            raise ValueError(f"format={fmt} needs pyarrow on the server")
+    elif fmt not in ("csv", "ndjson", "json"):
+        fmt = "csv"
+
+    partition = (args.get("partition") or "time").lower()
+    by_device = partition == "device" and len(uids) > 1
+    if EXPORT_SLICE_HOURS > 0 and (hours > EXPORT_SLICE_HOURS or by_device):
+        rows = _export_sliced_rows(hours, uids, limit, by_device)
+    else:
+        records = _influx_query_stream(_export_query(f"-{hours}h", uids, limit))
+        rows = (row for row in map(_export_row, records) if row is not None)
+
+    if fmt in ("parquet", "arrow"):
+        # already compressed / binary: gzip=1 is ignored
+        return (
+            _export_columnar(rows, fmt),
+            {"parquet": "application/vnd.apache.parquet", "arrow": "application/vnd.apache.arrow.stream"}[fmt],
+            {"Content-Disposition": f"attachment; filename=export.{fmt}"},
+        )
+
+    writer = {"csv": _export_csv, "ndjson": _export_ndjson, "json": _export_json}[fmt]
+    mimetype = {"csv": "text/csv", "ndjson": "application/x-ndjson", "json": "application/json"}[fmt]
+    body = _chunked(writer(rows))
+    filename = f"export.{fmt}"
+    if gz:
+        body, mimetype, filename = _gzipped(body), "application/gzip", filename + ".gz"
+
+    return body, mimetype, {"Content-Disposition": f"attachment; filename={filename}"}
 
-    range_expr = f"-{hours}h"
-    uid_filter = f'|> filter(fn: (r) => r.device_id == "{uid}")' if uid else ""
 
-    q = f"""
+def _export_query(range_expr: str, uids, limit: int = 0, stop_expr: str = None) -> str:
+    if len(uids) == 1:
+        uid_filter = f'|> filter(fn: (r) => r.device_id == "{uids[0]}")'
+    elif uids:
+        uid_filter = f"|> filter(fn: (r) => contains(value: r.device_id, set: {json.dumps(uids)}))"
+    else:
+        uid_filter = ""
+    limit_stage = f"|> limit(n: {limit})" if limit > 0 else ""
+
+    return f"""
 from(bucket: "{INFLUX_BUCKET}")
-  |> range(start: {range_expr})
+  |> range(start: {range_expr}{f", stop: {stop_expr}" if stop_expr else ""})
   |> filter(fn: (r) => r._measurement == "{MEASUREMENT}")
   |> filter(fn: (r) => r.team == "{TEAM_FILTER}")
   {uid_filter}
@@ -394,72 +1346,261 @@ from(bucket: "{INFLUX_BUCKET}")
   |> group(columns: ["device_id","_field"])     // FIX: glue open/closed series
   |> keep(columns: ["_time","device_id","valve_state","_field","_value"])
   |> pivot(rowKey: ["_time","device_id"], columnKey: ["_field"], valueColumn: "_value") // FIX: no valve_state in rowKey
-  |> sort(columns: ["_time"], desc: false)
-  |> limit(n: {limit})
+  |> group()                                    // one table: sort and limit are global, not per device
+  |> sort(columns: ["_time","device_id"], desc: false)
+  {limit_stage}
 """
 
-    rows = []
-    for t in _influx_query(q):
-        for r in t.records:
-            ts = r.values.get("_time") or r.get_time()
-            if not ts:
-                continue
 
-            device_id = r.values.get("device_id")
-            valve_state = r.values.get("valve_state")
+def _export_slice(query: str):
+    t0 = time.perf_counter()
+    rows = [row for row in map(_export_row, _influx_query_stream(query)) if row is not None]
+    return rows, time.perf_counter() - t0
 
-            p_now = fmt_float(r.values.get("pressure_now"))
-            p_prev = r.values.get("pressure_prev")
-            if p_prev is None:
-                p_prev = r.values.get("pressure_30ms_ago")
-            p_prev = fmt_float(p_prev)
 
-            delta = (p_now - p_prev) if (p_now is not None and p_prev is not None) else None
+def _export_sliced_rows(hours: int, uids, limit: int, by_device: bool):
+    """
+    Range split into EXPORT_SLICE_HOURS slices (x devices when by_device), fetched on
+    _export_pool. Slices are emitted strictly in time order, each one sorted, so the
+    output stays sorted; at most ~2 x EXPORT_WORKERS slices are held at once.
+    The first slice is awaited here, so a failing Influx still fails the request early.
+    """
+    stop_ms = int(time.time() * 1000)
+    start_ms = stop_ms - hours * 3600 * 1000
+    step = int(EXPORT_SLICE_HOURS * 3600 * 1000)
+    bounds = [(t, min(t + step, stop_ms)) for t in range(start_ms, stop_ms, step)]
+    parts = [[u] for u in uids] if by_device else [uids]
+
+    def submit(i):
+        a, b = bounds[i]
+        return [
+            _export_pool.submit(_export_slice, _export_query(_flux_time(a), p, limit, _flux_time(b)))
+            for p in parts
+        ]
+
+    window = max(1, EXPORT_WORKERS * 2 // len(parts))
+    pending = deque(submit(i) for i in range(min(window, len(bounds))))
+    t_start = time.perf_counter()
+    print(f"[EXPORT] {hours}h devices={','.join(uids) or 'all'} slices={len(bounds)}x{len(parts)} workers={EXPORT_WORKERS}")
+
+    def cancel_pending():
+        for futures in pending:
+            for f in futures:
+                f.cancel()
+
+    def collect(i):
+        # next slice in order; refill the window before blocking on it
+        futures = pending.popleft()
+        if i + len(pending) + 1 < len(bounds):
+            pending.append(submit(i + len(pending) + 1))
+        rows, took = [], 0.0
+        for f in futures:
+            r, dt = f.result()
+            rows.extend(r)
+            took = max(took, dt)
+        if len(parts) > 1:
+            # per-device queries come back sorted each; merge into the query's (time, device) order
+            rows.sort(key=lambda r: (r["timestamp_ms"], r["device_id"] or ""))
+        a, b = bounds[i]
+        print(f"[EXPORT] slice {i + 1}/{len(bounds)} {_flux_time(a)}..{_flux_time(b)} rows={len(rows)} query_s={took:.2f}")
+        return rows
 
-            t_utc = ts.astimezone(timezone.utc)
-            rows.append({
-                "device_id": device_id,
-                "timestamp": int(t_utc.timestamp()),      # seconds
-                "timestamp_ms": int(t_utc.timestamp() * 1000),
-                "valve_state": valve_state,
-                "pressure_30ms_ago": p_prev,
-                "pressure_now": p_now,
-                "pressure_delta": delta
-            })
+    try:
+        first = collect(0)
+    except Exception:
+        cancel_pending()
+        raise
 
-    if fmt == "json":
-        return Response(
-            json.dumps(rows, ensure_ascii=False),
-            mimetype="application/json",
-            headers={"Content-Disposition": "attachment; filename=export.json"}
-        )
+    def gen():
+        sent = 0
+        try:
+            for i in range(len(bounds)):
+                for r in (first if i == 0 else collect(i)):
+                    if limit and sent >= limit:
+                        return
+                    yield r
+                    sent += 1
+        finally:
+            cancel_pending()
+            print(f"[EXPORT] done rows={sent} total_s={time.perf_counter() - t_start:.2f}")
+
+    return gen()
+
+
+def _export_row(r):
+    ts = r.values.get("_time") or r.get_time()
+    if not ts:
+        return None
+
+    p_now = fmt_float(r.values.get("pressure_now"))
+    p_prev = r.values.get("pressure_prev")
+    if p_prev is None:
+        p_prev = r.values.get("pressure_30ms_ago")
+    p_prev = fmt_float(p_prev)
+
+    delta = (p_now - p_prev) if (p_now is not None and p_prev is not None) else None
+
+    t_utc = ts.astimezone(timezone.utc)
+    return {
+        "device_id": r.values.get("device_id"),
+        "timestamp": int(t_utc.timestamp()),      # seconds
+        "timestamp_ms": int(t_utc.timestamp() * 1000),
+        "valve_state": r.values.get("valve_state"),
+        "pressure_30ms_ago": p_prev,
+        "pressure_now": p_now,
+        "pressure_delta": delta
+    }
 
-    # CSV default
+
+def _export_csv(rows):
     import csv
     from io import StringIO
 
     buf = StringIO()
-    w = csv.DictWriter(buf, fieldnames=[
-        "device_id", "timestamp", "timestamp_ms", "valve_state",
-        "pressure_30ms_ago", "pressure_now", "pressure_delta"
-    ])
+    w = csv.DictWriter(buf, fieldnames=EXPORT_FIELDS)
     w.writeheader()
     for r in rows:
         w.writerow(r)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    yield buf.getvalue()
+
+
+def _export_ndjson(rows):
+    for r in rows:
+        yield json.dumps(r, ensure_ascii=False) + "\n"
 
-    return Response(
-        buf.getvalue(),
-        mimetype="text/csv",
-        headers={"Content-Disposition": "attachment; filename=export.csv"}
-    )
+
+def _export_json(rows):
+    # same document as before (one array), written element by element
+    sep = "["
+    for r in rows:
+        yield sep + json.dumps(r, ensure_ascii=False)
+        sep = ","
+    yield "[]" if sep == "[" else "]"
+
+
+def _export_schema():
+    # typed time + float64 pressures; device_id / valve_state repeat a lot => dictionary columns
+    dict_str = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema([
+        ("time", pa.timestamp("ms", tz="UTC")),
+        ("device_id", dict_str),
+        ("valve_state", dict_str),
+        ("pressure_30ms_ago", pa.float64()),
+        ("pressure_now", pa.float64()),
+        ("pressure_delta", pa.float64()),
+    ])
+
+
+def _export_batch(schema, rows):
+    cols = [
+        pa.array([r["timestamp_ms"] for r in rows], type=pa.int64()).cast(schema.field("time").type),
+        pa.array([r["device_id"] for r in rows], type=pa.string()).dictionary_encode(),
+        pa.array([r["valve_state"] for r in rows], type=pa.string()).dictionary_encode(),
+        pa.array([r["pressure_30ms_ago"] for r in rows], type=pa.float64()),
+        pa.array([r["pressure_now"] for r in rows], type=pa.float64()),
+        pa.array([r["pressure_delta"] for r in rows], type=pa.float64()),
+    ]
+    return pa.RecordBatch.from_arrays(cols, schema=schema)
+
+
+class _ChunkSink:
+    """
+    Write-only file object for pyarrow writers; written bytes are collected
+    and handed out by take(), so the generator can yield them right away.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.pos = 0
+        self.closed = False
+
+    def write(self, data):
+        b = bytes(data)
+        self.parts.append(b)
+        self.pos += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.pos
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self):
+        return True
+
+    def take(self) -> bytes:
+        out, self.parts = b"".join(self.parts), []
+        return out
+
+
+def _export_columnar(rows, fmt: str):
+    """
+    Parquet (one row group per EXPORT_BATCH_ROWS rows) or Arrow IPC stream (one record batch each).
+    Only one batch of rows is held at a time.
+    """
+    schema = _export_schema()
+    sink = _ChunkSink()
+    if fmt == "parquet":
+        writer = pq.ParquetWriter(sink, schema, compression=EXPORT_PARQUET_COMPRESSION)
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+
+    batch = []
+    for r in itertools.chain(rows, [None]):
+        if r is not None:
+            batch.append(r)
+            if len(batch) < EXPORT_BATCH_ROWS:
+                continue
+        if batch:
+            writer.write_batch(_export_batch(schema, batch))
+            batch = []
+            out = sink.take()
+            if out:
+                yield out
+    writer.close()
+    yield sink.take()
+
+
+def _chunked(pieces, size: int = EXPORT_CHUNK_BYTES):
+    # glue tiny per-row strings into ~size byte chunks (fewer writes / gzip calls)
+    parts, n = [], 0
+    for p in pieces:
+        parts.append(p)
+        n += len(p)
+        if n >= size:
+            yield "".join(parts).encode("utf-8")
+            parts, n = [], 0
+    if parts:
+        yield "".join(parts).encode("utf-8")
+
+
+def _gzipped(chunks):
+    z = zlib.compressobj(EXPORT_GZIP_LEVEL, zlib.DEFLATED, 31)  # 31 => gzip container
+    for c in chunks:
+        out = z.compress(c)
+        if out:
+            yield out
+    yield z.flush()
 
 
 @app.get("/health")
 def health():
+    payload, status = health_payload()
+    return jsonify(payload), status
+
+
+def health_payload():
     try:
-        with influx_client() as c:
-            ok = c.ping()
-        return jsonify({
+        ok = influx_client().ping()  # ping() returns False instead of raising
+        _influx_result(ok, None if ok else "ping failed")
+        return {
             "ok": ok,
             "bucket": INFLUX_BUCKET,
             "org": INFLUX_ORG,
@@ -468,11 +1609,19 @@ def health():
             "range": INFLUX_RANGE,
             "timeout_ms": INFLUX_TIMEOUT_MS,
             "templates_dir": str(TEMPLATES_DIR),
+            "templates_index": template_index_stats(),
             "sse_interval_ms": SSE_INTERVAL_MS,
+            "sse": sse_stats(),
+            "history_query_mode": HISTORY_QUERY_MODE,
+            "history_cache": history_cache_stats(),
             "cache_ttl_sec": CACHE_TTL_SEC,
-        })
+            "latest_cache": latest_cache_stats(),
+            "page_cache": page_cache_stats(),
+            "latest_store": latest_store_stats(),
+            "influx_pool": influx_pool_stats(),
+        }, 200
     except Exception as e:
-        return jsonify({"ok": False, "error": str(e)}), 500
+        return {"ok": False, "error": str(e)}, 500
 
 
 @app.get("/api/devices/latest")
@@ -483,36 +1632,178 @@ def api_devices_latest():
     })
 
 
-@app.get("/events/devices")
-def events_devices():
+def _sse_frame(event: str, payload, event_id=None) -> bytes:
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{head}event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+class _SseClient:
+    # q: anything with put_nowait() raising queue.Full (asgi.py passes an asyncio bridge)
+    def __init__(self, q=None):
+        self.queue = q if q is not None else queue.Queue(maxsize=max(1, SSE_CLIENT_QUEUE))
+        self.dropped = threading.Event()
+        self.needs_full = False  # subscribed before the first tick: gets a full snapshot, not a delta
+
+
+def _sse_tick():
     """
-    Server-Sent Events stream. Pushes device snapshot JSON.
+    Loads the latest devices and diffs them against the last broadcast.
+    Returns (meta, devices_by_uid, changed, removed) or raises.
     """
-    def gen():
-        yield "retry: 2000\n\n"
-        while True:
+    if _use_latest_store():
+        cache_ts, cache_error = time.time(), None
+    else:
+        with _cache_lock:
+            cache_ts = _latest_cache["ts"]
+            cache_error = _latest_cache["error"]
+
+    devices = load_latest_devices()
+    meta = {
+        "server_time_utc": utc_now().strftime("%Y-%m-%d %H:%M:%S"),
+        "cache_age_ms": int((time.time() - cache_ts) * 1000) if cache_ts else None,
+        "cache_error": cache_error,
+    }
+    prev = _sse_state["devices"] or {}
+    cur = {d["device_id"]: d for d in devices}
+    changed = [d for uid, d in cur.items() if prev.get(uid) != d]
+    removed = [uid for uid in prev if uid not in cur]
+    return meta, cur, changed, removed
+
+
+def _sse_full_frame() -> bytes:
+    # under _sse_lock; one serialisation per event id, shared by all new subscribers
+    full = _sse_state["full"]
+    if full is not None and full[0] == _sse_state["id"]:
+        return full[1]
+    devices = sorted((_sse_state["devices"] or {}).values(), key=lambda x: x["device_id"])
+    frame = _sse_frame("devices", {**_sse_state["meta"], "devices": devices}, _sse_state["id"])
+    _sse_state["full"] = (_sse_state["id"], frame)
+    return frame
+
+
+def _sse_broadcaster():
+    """
+    Single producer for /events/devices: one load + one json.dumps per tick for all streams.
+    """
+    while True:
+        with _sse_lock:
+            clients = list(_sse_clients)
+
+        if clients:
+            full = None
             try:
-                with _cache_lock:
-                    cache_ts = _latest_cache["ts"]
-                    cache_error = _latest_cache["error"]
-
-                payload = {
-                    "server_time_utc": utc_now().strftime("%Y-%m-%d %H:%M:%S"),
-                    "cache_age_ms": int((time.time() - cache_ts) * 1000) if cache_ts else None,
-                    "cache_error": cache_error,
-                    "devices": load_latest_devices()
-                }
-
-                yield ": keepalive\n\n"
-                yield "event: devices\n"
-                yield f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+                meta, cur, changed, removed = _sse_tick()
+                with _sse_lock:
+                    _sse_state["id"] += 1
+                    event_id = _sse_state["id"]
+                    frame = _sse_frame("delta", {**meta, "changed": changed, "removed": removed}, event_id)
+                    _sse_state["devices"] = cur
+                    _sse_state["meta"] = meta
+                    _sse_state["ring"].append((event_id, frame))
+                    clients = list(_sse_clients)
+                    if any(c.needs_full for c in clients):
+                        full = _sse_full_frame()
             except Exception as e:
-                err = {"error": str(e)}
-                yield "event: error\n"
-                yield f"data: {json.dumps(err, ensure_ascii=False)}\n\n"
-
+                frame = _sse_frame("error", {"error": str(e)})
+
+            _sse_state["stats"]["frames"] += 1
+            for c in clients:
+                try:
+                    if full is not None and c.needs_full:
+                        c.queue.put_nowait(full)
+                        c.needs_full = False
+                        _sse_state["stats"]["full_sent"] += 1
+                    else:
+                        c.queue.put_nowait(frame)
+                except queue.Full:
+                    # slow reader: drop it instead of buffering / stalling the others
+                    c.dropped.set()
+                    _sse_unsubscribe(c)
+                    _sse_state["stats"]["disconnected_slow"] += 1
+
+        if clients and _use_latest_store():
+            # store mode: push as soon as the listener writes (at most every 0.1s)
+            time.sleep(0.1)
+            latest_store_wait(max(0.3, SSE_INTERVAL_MS / 1000.0))
+        else:
             time.sleep(max(0.3, SSE_INTERVAL_MS / 1000.0))
 
+
+def _sse_subscribe(last_event_id=None, c=None):
+    """
+    Registers a stream. Returns (client, initial frames): missed deltas when
+    Last-Event-ID is still in the ring, otherwise one full snapshot (sent on the
+    first tick instead when nothing has been broadcast yet).
+    """
+    c = c or _SseClient()
+    with _sse_lock:
+        initial = []
+        ring = _sse_state["ring"]
+        cur_id = _sse_state["id"]
+        if last_event_id is not None and ring and ring[0][0] - 1 <= last_event_id <= cur_id:
+            initial = [frame for eid, frame in ring if eid > last_event_id]
+            _sse_state["stats"]["resumed"] += 1
+        elif _sse_state["devices"] is not None:
+            initial = [_sse_full_frame()]
+            _sse_state["stats"]["full_sent"] += 1
+        else:
+            # nothing broadcast yet (first subscriber after startup): snapshot on the first tick
+            c.needs_full = True
+        _sse_clients.add(c)
+
+        t = _sse_state["thread"]
+        if t is None or not t.is_alive():
+            t = threading.Thread(target=_sse_broadcaster, name="sse-broadcaster", daemon=True)
+            _sse_state["thread"] = t
+            t.start()
+    return c, initial
+
+
+def _sse_unsubscribe(c: _SseClient):
+    with _sse_lock:
+        _sse_clients.discard(c)
+
+
+def sse_last_event_id(headers, args):
+    raw = headers.get("Last-Event-ID") or args.get("last_event_id")
+    try:
+        return int(raw) if raw else None
+    except ValueError:
+        return None
+
+
+def sse_stats() -> dict:
+    with _sse_lock:
+        n = len(_sse_clients)
+        return {"clients": n, "event_id": _sse_state["id"], "ring": len(_sse_state["ring"]), **_sse_state["stats"]}
+
+
+@app.get("/events/devices")
+def events_devices():
+    """
+    Server-Sent Events stream (produced by the shared broadcaster):
+      event: devices  full snapshot {server_time_utc, ..., devices: [...]}
+      event: delta    {server_time_utc, ..., changed: [...], removed: [uid, ...]}
+    Reconnect with Last-Event-ID gets only the deltas it missed.
+    """
+    client, initial = _sse_subscribe(sse_last_event_id(request.headers, request.args))
+
+    def gen():
+        try:
+            yield b"retry: 2000\n\n"
+            # snapshot / missed deltas right away, new tab doesn't wait a full interval
+            for frame in initial:
+                yield frame
+            while not client.dropped.is_set():
+                try:
+                    frame = client.queue.get(timeout=SSE_KEEPALIVE_SEC)
+                except queue.Empty:
+                    yield b": keepalive\n\n"
+                    continue
+                yield frame
+        finally:
+            _sse_unsubscribe(client)
+
     return Response(gen(), mimetype="text/event-stream", headers={
         "Cache-Control": "no-cache",
         "X-Accel-Buffering": "no",
@@ -520,11 +1811,8 @@ def events_devices():
     })
 
 
-@app.get("/")
-def index():
-    devices = load_latest_devices()
-
-    html = r"""
+# Page templates are compiled once here, not on every request
+INDEX_PAGE = app.jinja_env.from_string(r"""
 <!doctype html>
 <html lang="en">
 <head>
@@ -851,15 +2139,36 @@ th:nth-child(6), td:nth-child(6){
     viewCell.innerHTML = `<a class="view-link ${hasView ? "" : "disabled"}" href="/device/${encodeURIComponent(uid)}">${hasView ? "Open" : "No init"}</a>`;
   }
 
-  function applySnapshot(snapshot){
-    if (serverTimeEl && snapshot.server_time_utc){
-      serverTimeEl.textContent = snapshot.server_time_utc;
+  function setServerTime(msg){
+    if (serverTimeEl && msg.server_time_utc){
+      serverTimeEl.textContent = msg.server_time_utc;
     }
+  }
+
+  function removeRow(uid){
+    const row = tbody.querySelector(`tr[data-uid="${CSS.escape(uid)}"]`);
+    if (row) row.remove();
+  }
+
+  // full snapshot: rows not in it are gone
+  function applySnapshot(snapshot){
+    setServerTime(snapshot);
     const list = snapshot.devices || [];
+    const keep = new Set(list.map(d => d.device_id));
+    for (const row of Array.from(tbody.querySelectorAll("tr[data-uid]"))){
+      if (!keep.has(row.getAttribute("data-uid"))) row.remove();
+    }
     list.sort((a,b) => (a.device_id || "").localeCompare(b.device_id || ""));
     for (const d of list) updateRow(d);
   }
 
+  // delta: only changed / removed devices
+  function applyDelta(delta){
+    setServerTime(delta);
+    for (const d of (delta.changed || [])) updateRow(d);
+    for (const uid of (delta.removed || [])) removeRow(uid);
+  }
+
   // ===== SSE wiring =====
   const es = new EventSource("/events/devices");
 
@@ -878,6 +2187,12 @@ th:nth-child(6), td:nth-child(6){
     }catch(e){}
   });
 
+  es.addEventListener("delta", (evt) => {
+    try{
+      applyDelta(JSON.parse(evt.data));
+    }catch(e){}
+  });
+
   es.addEventListener("error", (evt) => {
     try{
       const payload = JSON.parse(evt.data);
@@ -888,9 +2203,15 @@ th:nth-child(6), td:nth-child(6){
 
 </body>
 </html>
-"""
-    return render_template_string(
-        html,
+""")
+
+
+@app.get("/")
+def index():
+    devices = load_latest_devices()
+
+    return render_template(
+        INDEX_PAGE,
         devices=devices,
         team=TEAM_FILTER,
         bucket=INFLUX_BUCKET,
@@ -899,11 +2220,7 @@ th:nth-child(6), td:nth-child(6){
     )
 
 
-@app.get("/device/<uid>")
-def device_view(uid: str):
-    p = template_path_for(uid)
-    if not p.exists():
-        html = r"""
+NO_INIT_PAGE = app.jinja_env.from_string(r"""
 <!doctype html>
 <html lang="en">
 <head>
@@ -939,12 +2256,10 @@ a{ color:#8ab4ff; text-decoration:none; }
   </div>
 </body>
 </html>
-"""
-        return render_template_string(html, uid=uid, path=str(p))
+""")
 
-    fragment = p.read_text(encoding="utf-8", errors="replace")
 
-    page = r"""
+DEVICE_PAGE = app.jinja_env.from_string(r"""
 <!doctype html>
 <html lang="en">
 <head>
@@ -990,6 +2305,11 @@ a{ color:#8ab4ff; text-decoration:none; }
     return list.find(d => d.device_id === uid);
   }
 
+  function pickChanged(delta){
+    const list = delta && delta.changed ? delta.changed : [];
+    return list.find(d => d.device_id === uid);
+  }
+
   function pushToFragment(d){
     if (!d) return;
     if (typeof window.handleSensorUpdate !== "function") return;
@@ -1008,9 +2328,12 @@ a{ color:#8ab4ff; text-decoration:none; }
   es.onopen = () => { if (conn) conn.textContent = "connected"; };
   es.onerror = () => { if (conn) conn.textContent = "reconnecting…"; };
 
+  // ~2 points per CSS pixel is plenty for the chart
+  const maxPoints = Math.max(300, Math.min(4000, Math.round((window.innerWidth || 1000) * 2)));
+
   async function loadHistory(){
     try{
-      const res = await fetch(`/api/device/${encodeURIComponent(uid)}/history?hours=24&limit=50`, { cache: "no-store" });
+      const res = await fetch(`/api/device/${encodeURIComponent(uid)}/history?hours=24&limit=50&max_points=${maxPoints}`, { cache: "no-store" });
       const snap = await res.json();
       if (typeof window.handleHistorySnapshot === "function"){
         window.handleHistorySnapshot(snap);
@@ -1031,12 +2354,72 @@ a{ color:#8ab4ff; text-decoration:none; }
       pushToFragment(d);
     }catch(e){}
   });
+
+  es.addEventListener("delta", (evt) => {
+    try{
+      pushToFragment(pickChanged(JSON.parse(evt.data)));
+    }catch(e){}
+  });
 })();
 </script>
 </body>
 </html>
-"""
-    return render_template_string(page, uid=uid, fragment=fragment)
+""")
+
+
+def device_page(uid: str, accept_encoding: str = ""):
+    """
+    Rendered /device/<uid> as (body bytes, headers). The page only depends on uid and the
+    init fragment, so it is cached (plain + gzip) per (uid, fragment path) - several uids
+    map to one file but the page embeds the raw uid - and rebuilt when the file's
+    mtime/size change; a hit costs one stat(). Needs the Flask app context.
+    """
+    p = template_path_for(uid)
+    ck = (uid, p)
+    headers = {"Content-Type": "text/html; charset=utf-8"}
+    try:
+        st = p.stat()
+    except OSError:
+        html = render_template(NO_INIT_PAGE, uid=uid, path=str(p))
+        return html.encode("utf-8"), headers
+
+    key = (st.st_mtime_ns, st.st_size)
+    with _page_cache_lock:
+        hit = _page_cache.get(ck)
+        if hit is not None and hit[0] == key:
+            _page_cache.move_to_end(ck)
+            _page_cache_stats["hits"] += 1
+        else:
+            hit = None
+            _page_cache_stats["misses"] += 1
+
+    if hit is None:
+        fragment = p.read_text(encoding="utf-8", errors="replace")
+        body = render_template(DEVICE_PAGE, uid=uid, fragment=fragment).encode("utf-8")
+        hit = (key, body, gzip.compress(body, compresslevel=9))
+        with _page_cache_lock:
+            _page_cache[ck] = hit
+            _page_cache.move_to_end(ck)
+            while len(_page_cache) > max(1, PAGE_CACHE_MAX):
+                _page_cache.popitem(last=False)
+
+    headers["Vary"] = "Accept-Encoding"
+    # q-values matter: "gzip;q=0" and "identity, *;q=0" both refuse gzip.
+    if parse_accept_header(accept_encoding or "")["gzip"] > 0:
+        headers["Content-Encoding"] = "gzip"
+        return hit[2], headers
+    return hit[1], headers
+
+
+def page_cache_stats() -> dict:
+    with _page_cache_lock:
+        return {"entries": len(_page_cache), "max": PAGE_CACHE_MAX, **_page_cache_stats}
+
+
+@app.get("/device/<uid>")
+def device_view(uid: str):
+    body, headers = device_page(uid, request.headers.get("Accept-Encoding", ""))
+    return Response(body, headers=headers)
 
 
 # ===================== MAIN =====================
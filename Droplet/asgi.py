@@ -0,0 +1,157 @@
+# asgi.py
+"""
+Async (ASGI) serving mode for the dashboard: same routes as app.py, one event loop.
+
+  python asgi.py                  # uvicorn on PORT
+  uvicorn asgi:app --port 5000
+
+/events/devices streams are plain asyncio tasks fed by app.py's shared SSE
+broadcaster, so an idle subscriber costs a queue and a socket, not an OS thread.
+Everything that talks to Influx (history, latest, export, health, page render)
+runs on a bounded executor, so a slow query never blocks the loop.
+"""
+import asyncio
+import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+import app as dashboard
+
+# ===================== CONFIG =====================
+ASGI_INFLUX_WORKERS = int(os.getenv("ASGI_INFLUX_WORKERS", "8"))
+_executor = ThreadPoolExecutor(max_workers=max(1, ASGI_INFLUX_WORKERS), thread_name_prefix="influx")
+
+
+# ===================== HELPERS =====================
+def _in_app(fn, *args, **kwargs):
+    # render_template & co. need the Flask app context
+    with dashboard.app.app_context():
+        return fn(*args, **kwargs)
+
+
+async def _run(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, lambda: _in_app(fn, *args, **kwargs))
+
+
+class _LoopQueue:
+    """
+    Thread-side face of an asyncio.Queue: the broadcaster thread calls put_nowait(),
+    the frame is handed to the event loop. Raises queue.Full like queue.Queue.
+    """
+
+    def __init__(self, loop, maxsize: int):
+        self.loop = loop
+        self.q = asyncio.Queue(maxsize=maxsize)
+
+    def put_nowait(self, frame: bytes):
+        if self.q.full():
+            raise queue.Full
+        self.loop.call_soon_threadsafe(self._put, frame)
+
+    def _put(self, frame: bytes):
+        try:
+            self.q.put_nowait(frame)
+        except asyncio.QueueFull:
+            pass  # filled up between check and hand-off; next put_nowait drops the client
+
+
+# ===================== ROUTES =====================
+async def index(request: Request):
+    return HTMLResponse(await _run(dashboard.index))
+
+
+async def device_view(request: Request):
+    body, headers = await _run(
+        dashboard.device_page, request.path_params["uid"], request.headers.get("accept-encoding", "")
+    )
+    return Response(body, headers=headers)
+
+
+async def api_device_history(request: Request):
+    uid = request.path_params["uid"]
+    try:
+        hours = int(request.query_params.get("hours", "24"))
+        limit = int(request.query_params.get("limit", "50"))
+        max_points = int(request.query_params.get("max_points", request.query_params.get("width", "0")))
+    except ValueError as e:
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=400)
+    return JSONResponse(await _run(
+        dashboard.load_device_history, uid, hours=hours, limit_events=limit, max_points=max_points
+    ))
+
+
+async def api_export(request: Request):
+    try:
+        body, mimetype, headers = await _run(dashboard.build_export, request.query_params)
+    except ValueError as e:
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=400)
+    # generator body: Starlette iterates sync iterators in its threadpool
+    return StreamingResponse(body, media_type=mimetype, headers=headers)
+
+
+async def health(request: Request):
+    payload, status = await _run(dashboard.health_payload)
+    payload["server"] = "asgi"
+    return JSONResponse(payload, status_code=status)
+
+
+async def api_devices_latest(request: Request):
+    devices = await _run(dashboard.load_latest_devices)
+    return JSONResponse({
+        "server_time_utc": dashboard.utc_now().strftime("%Y-%m-%d %H:%M:%S"),
+        "devices": devices,
+    })
+
+
+async def events_devices(request: Request):
+    """
+    Same stream as app.py /events/devices (full snapshot, then deltas, Last-Event-ID resume).
+    """
+    loop = asyncio.get_running_loop()
+    client = dashboard._SseClient(_LoopQueue(loop, max(1, dashboard.SSE_CLIENT_QUEUE)))
+    client, initial = dashboard._sse_subscribe(
+        dashboard.sse_last_event_id(request.headers, request.query_params), client
+    )
+
+    async def gen():
+        try:
+            yield b"retry: 2000\n\n"
+            for frame in initial:
+                yield frame
+            while not client.dropped.is_set():
+                try:
+                    frame = await asyncio.wait_for(client.queue.q.get(), timeout=dashboard.SSE_KEEPALIVE_SEC)
+                except asyncio.TimeoutError:
+                    yield b": keepalive\n\n"
+                    continue
+                yield frame
+        finally:
+            dashboard._sse_unsubscribe(client)
+
+    return StreamingResponse(gen(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
+
+app = Starlette(routes=[
+    Route("/", index),
+    Route("/device/{uid}", device_view),
+    Route("/api/device/{uid}/history", api_device_history),
+    Route("/api/export", api_export),
+    Route("/health", health),
+    Route("/api/devices/latest", api_devices_latest),
+    Route("/events/devices", events_devices),
+])
+
+
+# ===================== MAIN =====================
+if __name__ == "__main__":
+    uvicorn.run(app, host="0.0.0.0", port=dashboard.PORT, log_level="warning", backlog=4096)
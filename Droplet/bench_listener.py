@@ -0,0 +1,164 @@
+"""
+Listener micro-benchmarks (no MQTT / Influx needed).
+
+- point:   old path, influxdb_client.Point with .tag()/.field()/.time() -> line protocol
+- encoder: listener.encode_status_line() straight into one reusable bytearray
+- json:    firmware-style JSON status -> json.loads + parse_status_record()
+- bin:     sensors/<uid>/status.bin v1 -> decode_status_bin(), one sample per message
+- bin_x100: same, 100 samples per message (buffer drain after reconnect)
+
+Each case handles N status samples for DEVICES devices and prints msgs/sec
+(samples/sec for the decode cases) and bytes on the wire / per sample.
+"""
+
+import os
+import json
+import time
+import random
+
+os.environ.setdefault("INFLUX_TOKEN", "bench")
+
+from influxdb_client import Point, WritePrecision
+
+import listener
+
+# -------- Config --------
+N = int(os.getenv("BENCH_N", "200000"))
+DEVICES = int(os.getenv("BENCH_DEVICES", "100"))
+REPEAT = int(os.getenv("BENCH_REPEAT", "3"))
+BIN_BATCH = int(os.getenv("BENCH_BIN_BATCH", "100"))
+
+
+# -------- Samples --------
+def make_samples(n, devices, seed=1):
+    rnd = random.Random(seed)
+    ts0 = 1_760_000_000_000
+    out = []
+    for i in range(n):
+        now = round(rnd.uniform(0.0, 7.0), 3)
+        out.append({
+            "device_id": f"atom-{i % devices:04d}",
+            "team": "TallinnAtom",
+            "valve_state": rnd.choice(("open", "closed")),
+            "pressure_now": now,
+            "pressure_prev": round(now - rnd.uniform(-0.2, 0.2), 3),
+            "timestamp_ms": ts0 + i * 10,
+        })
+    return out
+
+
+# -------- Cases --------
+def run_point(samples):
+    lines = []
+    for d in samples:
+        p_now, p_prev = d["pressure_now"], d["pressure_prev"]
+        point = (
+            Point(listener.MEASUREMENT)
+            .tag("device_id", d["device_id"])
+            .tag("team", d["team"])
+            .tag("valve_state", d["valve_state"])
+            .field("pressure_now", p_now)
+            .field("pressure_prev", p_prev)
+            .field("pressure_delta", p_now - p_prev)
+            .time(d["timestamp_ms"] * 1_000_000, WritePrecision.NS)
+        )
+        lines.append(point.to_line_protocol(precision=WritePrecision.NS).encode("utf-8"))
+    return b"\n".join(lines)
+
+
+def run_encoder(samples, buf=bytearray()):
+    del buf[:]
+    for d in samples:
+        buf += listener.encode_status_line(
+            d["device_id"], d["team"], d["valve_state"],
+            d["pressure_now"], d["pressure_prev"], d["timestamp_ms"] * 1_000_000,
+        )
+    return bytes(buf)
+
+
+def to_json_payloads(samples):
+    # как publishOldestSample() в прошивке: String(x, 3)
+    out = []
+    for d in samples:
+        out.append((
+            "{"
+            f'"device_id":"{d["device_id"]}",'
+            f'"team":"{d["team"]}",'
+            f'"timestamp_ms":{d["timestamp_ms"]},'
+            f'"valve_state":"{d["valve_state"]}",'
+            f'"pressure_30ms_ago":{d["pressure_prev"]:.3f},'
+            f'"pressure_now":{d["pressure_now"]:.3f}'
+            "}"
+        ).encode("utf-8"))
+    return out
+
+
+def to_bin_payloads(samples, batch):
+    out = []
+    for i in range(0, len(samples), batch):
+        out.append(listener.encode_status_bin(
+            (d["timestamp_ms"], d["pressure_now"], d["pressure_prev"], d["valve_state"])
+            for d in samples[i:i + batch]
+        ))
+    return out
+
+
+def run_json(payloads):
+    n = 0
+    for raw in payloads:
+        for d in listener.status_samples(json.loads(raw.decode("utf-8"))):
+            listener.parse_status_record("uid", d)
+            n += 1
+    return n
+
+
+def run_bin(payloads):
+    n = 0
+    for raw in payloads:
+        n += len(listener.decode_status_bin("uid", raw, "TallinnAtom"))
+    return n
+
+
+def bench_decode(name, fn, payloads, n_samples):
+    best = None
+    for _ in range(REPEAT):
+        t0 = time.perf_counter()
+        n = fn(payloads)
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    assert n == n_samples
+    size = sum(len(p) for p in payloads)
+    rate = n_samples / best
+    print(f"{name:<10} {rate:>12,.0f} samples/s   {size:>10,} bytes   {size / n_samples:6.1f} B/sample")
+    return rate
+
+
+def bench(name, fn, samples):
+    best = None
+    for _ in range(REPEAT):
+        t0 = time.perf_counter()
+        out = fn(samples)
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    rate = len(samples) / best
+    print(f"{name:<10} {rate:>12,.0f} msgs/s   {best * 1000:8.1f} ms   {len(out):>10,} bytes")
+    return rate, out
+
+
+def main():
+    samples = make_samples(N, DEVICES)
+    print(f"\n=== line protocol encode: N={N} devices={DEVICES} best of {REPEAT} ===")
+    r_point, out_point = bench("point", run_point, samples)
+    r_enc, out_enc = bench("encoder", run_encoder, samples)
+    same = out_point == out_enc.rstrip(b"\n")
+    print(f"speedup x{r_enc / r_point:.1f}, identical output: {same}")
+
+    print(f"\n=== status decode: N={N} best of {REPEAT} ===")
+    r_json = bench_decode("json", run_json, to_json_payloads(samples), N)
+    r_bin = bench_decode("bin", run_bin, to_bin_payloads(samples, 1), N)
+    r_binb = bench_decode(f"bin_x{BIN_BATCH}", run_bin, to_bin_payloads(samples, BIN_BATCH), N)
+    print(f"bin vs json x{r_bin / r_json:.1f}, bin_x{BIN_BATCH} vs json x{r_binb / r_json:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+SSE connection count vs server memory: Flask threaded (app.py) vs ASGI (asgi.py).
+
+- Starts the server in each mode as a subprocess on BENCH_PORT.
+- Opens idle /events/devices streams in steps (STEPS) and reads the first bytes of each.
+- After every step samples the server's RSS and thread count from /proc (Linux only).
+
+Influx is not needed: without it the stream only carries error/keepalive frames,
+which is exactly the "thousands of idle subscribers" case.
+"""
+
+import os
+import sys
+import time
+import json
+import socket
+import resource
+import subprocess
+
+# -------- Config --------
+HERE = os.path.dirname(os.path.abspath(__file__))
+PORT = int(os.getenv("BENCH_PORT", "5077"))
+STEPS = [int(x) for x in os.getenv("BENCH_STEPS", "100,500,1000,2000").split(",")]
+MODES = os.getenv("BENCH_MODES", "flask,asgi").split(",")
+SETTLE_SEC = float(os.getenv("BENCH_SETTLE_SEC", "2.0"))
+
+
+# -------- Helpers --------
+def proc_status(pid):
+    out = {}
+    with open(f"/proc/{pid}/status", encoding="utf-8") as f:
+        for line in f:
+            k, _, v = line.partition(":")
+            if k in ("VmRSS", "Threads"):
+                out[k] = int(v.split()[0])
+    return out.get("VmRSS", 0) // 1024, out.get("Threads", 0)
+
+
+def start_server(mode):
+    script = "app.py" if mode == "flask" else "asgi.py"
+    env = dict(os.environ, PORT=str(PORT), INFLUX_URL="", SSE_INTERVAL_MS="2000")
+    p = subprocess.Popen([sys.executable, script], cwd=HERE, env=env,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", PORT), timeout=0.5).close()
+            return p
+        except OSError:
+            time.sleep(0.2)
+    p.kill()
+    raise RuntimeError(f"{mode} server did not start")
+
+
+def open_stream():
+    s = socket.create_connection(("127.0.0.1", PORT), timeout=10)
+    s.sendall(b"GET /events/devices HTTP/1.1\r\nHost: localhost\r\nAccept: text/event-stream\r\n\r\n")
+    return s
+
+
+def run_mode(mode):
+    p = start_server(mode)
+    socks, rows = [], []
+    try:
+        rss0, thr0 = proc_status(p.pid)
+        rows.append({"connections": 0, "rss_mb": rss0, "threads": thr0})
+        for target in STEPS:
+            while len(socks) < target:
+                s = open_stream()
+                s.recv(256)  # headers + "retry:" => stream is really open
+                socks.append(s)
+            time.sleep(SETTLE_SEC)
+            rss, thr = proc_status(p.pid)
+            rows.append({"connections": len(socks), "rss_mb": rss, "threads": thr})
+            print(f"[{mode:>5}] conns={len(socks):>5} rss={rss:>5} MB threads={thr:>5}")
+    except OSError as e:
+        print(f"[{mode:>5}] stopped at {len(socks)} connections: {e}")
+    finally:
+        for s in socks:
+            s.close()
+        p.terminate()
+        p.wait(timeout=10)
+    return rows
+
+
+def main():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    print(f"\n=== SSE connections vs memory (steps {STEPS}) ===")
+    report = {m: run_mode(m) for m in MODES}
+    with open("bench_sse_report.json", "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print("\nReport saved -> bench_sse_report.json")
+
+
+if __name__ == "__main__":
+    main()
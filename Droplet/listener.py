@@ -1,20 +1,44 @@
 import json
+import math
 import os
+import signal
+import socket
+import sqlite3
+import struct
+import threading
 import time
+import zlib
+from collections import OrderedDict, deque
 from pathlib import Path
 from datetime import datetime, timezone
 
 import paho.mqtt.client as mqtt
-from influxdb_client import InfluxDBClient, Point, WritePrecision
+from influxdb_client import InfluxDBClient, WritePrecision
+from influxdb_client.client.write_api import SYNCHRONOUS
 
 # ===================== MQTT CONFIG =====================
 MQTT_HOST = os.getenv("MQTT_HOST", "127.0.0.1")
 MQTT_PORT = int(os.getenv("MQTT_PORT", "1883"))
 
-# слушаем два топика (status + init)
+# слушаем три топика (status + status.bin + init)
 MQTT_TOPIC_STATUS = os.getenv("MQTT_TOPIC_STATUS", "sensors/+/status")
+MQTT_TOPIC_STATUS_BIN = os.getenv("MQTT_TOPIC_STATUS_BIN", "sensors/+/status.bin")
 MQTT_TOPIC_INIT = os.getenv("MQTT_TOPIC_INIT", "sensors/+/init")
 
+# горизонтальное масштабирование: несколько listener'ов в одной группе
+# подписываются через $share/<group>/... и брокер делит сообщения между ними.
+# пусто => обычная подписка (один процесс получает всё).
+# NB: брокер раздаёт сообщения, а не устройства — порядок по uid гарантирован только внутри инстанса
+MQTT_SHARE_GROUP = os.getenv("MQTT_SHARE_GROUP", "").strip()
+# в группе id обязателен и должен переживать рестарт: по нему devices.<id>.json и топик статистики
+# (hostname-pid дал бы пустой реестр и новый файл при каждом перезапуске); без группы — только client_id
+INSTANCE_ID = os.getenv("LISTENER_INSTANCE_ID", "").strip()
+if not INSTANCE_ID and not MQTT_SHARE_GROUP:
+    INSTANCE_ID = f"{socket.gethostname()}-{os.getpid()}"
+# сюда каждый инстанс публикует свою статистику (видно распределение нагрузки); пусто => не публикуем.
+# без retain: иначе у брокера копятся сообщения от давно умерших инстансов
+MQTT_STATS_TOPIC = os.getenv("MQTT_STATS_TOPIC", "listeners/{instance}/stats")
+
 # ===================== INFLUX CONFIG =====================
 INFLUX_URL = os.getenv("INFLUX_URL", "http://127.0.0.1:8086")
 INFLUX_TOKEN = os.getenv("INFLUX_TOKEN", "")
@@ -22,16 +46,85 @@ INFLUX_ORG = os.getenv("INFLUX_ORG", "TallinnAtom")
 INFLUX_BUCKET = os.getenv("INFLUX_BUCKET", "TallinnAtom")
 
 MEASUREMENT = os.getenv("INFLUX_MEASUREMENT", "device_status")
+INFLUX_TIMEOUT_MS = int(os.getenv("INFLUX_TIMEOUT_MS", "10000"))
+
+# свой батчинг вместо batching write_api: пачка уходит синхронно, при ошибке — в spool
+INFLUX_BATCH_SIZE = int(os.getenv("INFLUX_BATCH_SIZE", "5000"))
+INFLUX_FLUSH_SEC = float(os.getenv("INFLUX_FLUSH_SEC", "1.0"))
+INFLUX_MAX_PENDING = int(os.getenv("INFLUX_MAX_PENDING", "50000"))  # строк в памяти, дальше — сразу в spool
 
 # ===================== FILE STORAGE =====================
 BASE_DIR = Path(__file__).resolve().parent
 TEMPL_DIR = BASE_DIR / "device_templates"
 TEMPL_DIR.mkdir(parents=True, exist_ok=True)
 
-DEVICES_JSON = BASE_DIR / "devices.json"
+# в shared-группе у каждого инстанса свой файл, иначе они перетирают друг друга
+DEVICES_JSON = BASE_DIR / (f"devices.{INSTANCE_ID}.json" if MQTT_SHARE_GROUP else "devices.json")
+
+# devices.json держим в памяти, на диск пишем пачкой: по таймеру или после N изменений
+DEVICES_FLUSH_SEC = float(os.getenv("DEVICES_FLUSH_SEC", "5.0"))
+DEVICES_FLUSH_EVERY = int(os.getenv("DEVICES_FLUSH_EVERY", "1000"))
+
+# ===================== SPOOL (Influx недоступен) =====================
+# write-ahead spool: сегменты с line protocol (NS), реплей большими пачками после восстановления
+SPOOL_DIR = Path(os.getenv("SPOOL_DIR", str(BASE_DIR / "spool")))
+SPOOL_SEGMENT_BYTES = int(os.getenv("SPOOL_SEGMENT_BYTES", str(16 * 1024 * 1024)))
+SPOOL_MAX_BYTES = int(os.getenv("SPOOL_MAX_BYTES", str(1024 * 1024 * 1024)))  # дальше удаляем самые старые
+SPOOL_FSYNC = os.getenv("SPOOL_FSYNC", "0") == "1"
+SPOOL_REPLAY_BATCH = int(os.getenv("SPOOL_REPLAY_BATCH", "10000"))
+SPOOL_REPLAY_LINES_PER_SEC = int(os.getenv("SPOOL_REPLAY_LINES_PER_SEC", "100000"))  # 0 = без лимита
+SPOOL_PROBE_SEC = float(os.getenv("SPOOL_PROBE_SEC", "5.0"))
+SPOOL_BACKOFF_MAX_SEC = float(os.getenv("SPOOL_BACKOFF_MAX_SEC", "60.0"))  # пауза после неудачного реплея растёт до этого
+# отвергнутые Influx (400/422) пачки откладываются в SPOOL_DIR/seg-*.bad и не повторяются
+
+# ===================== DEDUP =====================
+# повторы после реконнекта / QoS redelivery: помним последние DEDUP_WINDOW timestamp_ms
+# каждого устройства (буфер прошивки — 100 samples) и выкидываем совпадения до Influx
+DEDUP_WINDOW = int(os.getenv("DEDUP_WINDOW", "512"))  # 0 = выключено
+DEDUP_MAX_DEVICES = int(os.getenv("DEDUP_MAX_DEVICES", "10000"))
+
+# ===================== ROLLUPS =====================
+# агрегаты pressure_now по окнам считаем при записи и пишем в <MEASUREMENT>_<окно>
+# (device_status_1s, device_status_10s, ...); пусто => выключено.
+# в shared-группе инстанс видит только часть samples устройства — агрегаты были бы неполными,
+# поэтому по умолчанию там выключено
+ROLLUP_WINDOWS = os.getenv("ROLLUP_WINDOWS", "" if MQTT_SHARE_GROUP else "1s,10s,1m")
+ROLLUP_GRACE_SEC = float(os.getenv("ROLLUP_GRACE_SEC", "2.0"))  # окно закрывается, если устройство молчит every+grace
+ROLLUP_SWEEP_SEC = float(os.getenv("ROLLUP_SWEEP_SEC", "1.0"))
+
+# ===================== VALVE EVENTS =====================
+# смена valve_state устройства => отдельная точка в VALVE_EVENTS_MEASUREMENT
+# (как и rollups, в shared-группе по умолчанию выключено: инстанс видит не все samples)
+VALVE_EVENTS = os.getenv("VALVE_EVENTS", "0" if MQTT_SHARE_GROUP else "1") == "1"
+VALVE_EVENTS_MEASUREMENT = os.getenv("VALVE_EVENTS_MEASUREMENT", "valve_events")
+
+# ===================== LATEST STATE (для app.py) =====================
+# последнее состояние каждого устройства — в SQLite (WAL) рядом с app.py:
+# дашборд читает "сейчас" отсюда (доли мс), Influx нужен ему только для истории.
+# инстансы shared-группы пишут в одну базу, побеждает более свежий ts_ms. пусто => выключено
+LATEST_DB = os.getenv("LATEST_DB", str(BASE_DIR / "latest_state.db")).strip()
+LATEST_FLUSH_SEC = float(os.getenv("LATEST_FLUSH_SEC", "0.2"))  # пачка в одну транзакцию
+
+# ===================== PIPELINE =====================
+# on_message только кладёт сообщение в очередь; парсинг/Influx/диск — в воркерах.
+# воркер выбирается по uid => порядок сообщений одного устройства сохраняется
+WORKERS = max(1, int(os.getenv("LISTENER_WORKERS", "4")))
+QUEUE_MAX = max(1, int(os.getenv("LISTENER_QUEUE_MAX", "5000")))  # на одного воркера
+# block       — ждём место до QUEUE_BLOCK_SEC, потом дропаем новое
+# drop_new    — очередь полная => выкидываем пришедшее сообщение
+# drop_oldest — очередь полная => выкидываем самое старое, кладём новое
+QUEUE_POLICY = os.getenv("LISTENER_QUEUE_POLICY", "block").strip().lower()
+QUEUE_BLOCK_SEC = float(os.getenv("LISTENER_QUEUE_BLOCK_SEC", "0.5"))
+STATS_SEC = float(os.getenv("LISTENER_STATS_SEC", "30"))
 
 # защита: чтобы кто-то не прислал 10MB html и не убил диск/память
 MAX_INIT_BYTES = int(os.getenv("MAX_INIT_BYTES", "200000"))  # 200KB
+# status может прийти пачкой (массив или {"samples": [...]}) — ограничиваем размер пачки
+MAX_STATUS_SAMPLES = int(os.getenv("MAX_STATUS_SAMPLES", "1000"))
+
+# status.bin v1 без team: берём из devices.json (последний JSON status / v2), иначе это значение;
+# пусто => такие sample пропускаем и считаем (с team "unknown" дашборд их всё равно скрыл бы)
+DEFAULT_TEAM = os.getenv("DEFAULT_TEAM", "").strip()
 
 
 def now_utc():
@@ -52,8 +145,73 @@ def to_float(x, default=None):
         return default
 
 
+# ===================== LINE PROTOCOL =====================
+# быстрый путь для device_status: без Point, сразу байты line protocol.
+# экранирование/формат чисел такие же, как в influxdb_client.Point
+_LP_ESCAPE_KEY = str.maketrans({",": "\\,", "=": "\\=", " ": "\\ ", "\n": "\\n", "\t": "\\t", "\r": "\\r"})
+_LP_ESCAPE_MEASUREMENT = str.maketrans({",": "\\,", " ": "\\ ", "\n": "\\n", "\t": "\\t", "\r": "\\r"})
+# строковое поле: кроме \ и " экранируем перевод строки — иначе он рвёт line protocol (значение из payload)
+_LP_ESCAPE_STRING = str.maketrans({"\\": "\\\\", '"': '\\"', "\n": "\\n", "\r": "\\r"})
+_LP_PREFIX_MAX = 10000
+_lp_prefixes = {}
+
+
+def _lp_tag(key: str, value: str) -> str:
+    v = value.translate(_LP_ESCAPE_KEY)
+    if not v:
+        return ""
+    if v.endswith("\\"):
+        v += " "
+    return f",{key}={v}"
+
+
+def _lp_string(v: str) -> str:
+    return v.translate(_LP_ESCAPE_STRING)
+
+
+def _lp_float(v: float) -> str:
+    s = str(v)
+    return s[:-2] if s.endswith(".0") else s
+
+
+def lp_status_prefix(device_id: str, team: str, valve_state: str) -> str:
+    # "measurement,tags " — у устройства их пара штук (open/closed), кэшируем
+    key = (device_id, team, valve_state)
+    prefix = _lp_prefixes.get(key)
+    if prefix is None:
+        if len(_lp_prefixes) >= _LP_PREFIX_MAX:
+            _lp_prefixes.clear()
+        prefix = (
+            MEASUREMENT.translate(_LP_ESCAPE_MEASUREMENT)
+            + _lp_tag("device_id", device_id)
+            + _lp_tag("team", team)
+            + _lp_tag("valve_state", valve_state)
+            + " "
+        )
+        _lp_prefixes[key] = prefix
+    return prefix
+
+
+def encode_status_line(device_id: str, team: str, valve_state: str,
+                       pressure_now, pressure_prev, ts_ns: int) -> bytes:
+    # одна строка device_status с \n на конце; b"" если полей нет (Influx такое не примет)
+    fields = []
+    if pressure_now is not None and pressure_prev is not None:
+        delta = pressure_now - pressure_prev
+        if math.isfinite(delta):
+            fields.append("pressure_delta=" + _lp_float(delta))
+    if pressure_now is not None and math.isfinite(pressure_now):
+        fields.append("pressure_now=" + _lp_float(pressure_now))
+    if pressure_prev is not None and math.isfinite(pressure_prev):
+        fields.append("pressure_prev=" + _lp_float(pressure_prev))
+    if not fields:
+        return b""
+    prefix = lp_status_prefix(device_id, team, valve_state)
+    return f"{prefix}{','.join(fields)} {ts_ns}\n".encode("utf-8")
+
+
 def parse_topic(topic: str):
-    # sensors/<uid>/status OR sensors/<uid>/init
+    # sensors/<uid>/status OR sensors/<uid>/status.bin OR sensors/<uid>/init
     parts = topic.split("/")
     if len(parts) != 3:
         return None, None
@@ -61,11 +219,111 @@ def parse_topic(topic: str):
         return None, None
     uid = parts[1].strip()
     kind = parts[2].strip()
-    if not uid or kind not in ("status", "init"):
+    if not uid or kind not in ("status", "status.bin", "init"):
         return None, None
     return uid, kind
 
 
+def status_samples(data):
+    # один объект, массив объектов или {"device_id":..., "team":..., "samples": [...]}
+    # поля верхнего уровня служат значениями по умолчанию для каждого sample
+    if isinstance(data, list):
+        return [d for d in data if isinstance(d, dict)]
+    if not isinstance(data, dict):
+        return None
+    samples = data.get("samples")
+    if samples is None:
+        return [data]
+    if not isinstance(samples, list):
+        return None
+    common = {k: v for k, v in data.items() if k != "samples"}
+    return [{**common, **d} for d in samples if isinstance(d, dict)]
+
+
+def parse_status_record(uid: str, data: dict) -> dict:
+    ts_ms = to_int(data.get("timestamp_ms") or data.get("timestamp"))
+    if 0 < ts_ms < 10_000_000_000:
+        ts_ms *= 1000
+
+    return {
+        "device_id": str(data.get("device_id") or uid or "unknown"),
+        "team": str(data.get("team", "unknown")),
+        "valve_state": str(data.get("valve_state", "unknown")),
+        "ts_ms": ts_ms,
+        "pressure_now": to_float(data.get("pressure_now")),
+        "pressure_prev": to_float(data.get("pressure_30ms_ago") or data.get("pressure_prev")),
+    }
+
+
+# ===================== BINARY STATUS =====================
+# sensors/<uid>/status.bin, little-endian:
+#   v1: u8 version (=1), затем N записей по 17 байт
+#   v2: u8 version (=2), u8 team_len, team (utf-8), затем N записей по 17 байт
+#   запись: u64 ts_ms (0 = время не синхронизировано), f32 pressure_now, f32 pressure_prev, u8 valve_state
+STATUS_BIN_V1 = 1
+STATUS_BIN_V2 = 2
+STATUS_BIN_RECORD = struct.Struct("<QffB")
+VALVE_STATES = ("unknown", "open", "closed")  # индекс = enum в бинарном формате
+
+
+def decode_status_bin(uid: str, payload: bytes, team: str = None):
+    """
+    -> список записей как у parse_status_record(); None, если формат не тот.
+    v2 несёт team в заголовке, он главнее аргумента. В v1 team нет: берётся аргумент
+    (team из devices.json); если и его нет — у записей team=None, вызывающий их не пишет
+    (пропускает и считает, пока team не станет известен из JSON status или v2).
+    """
+    if not payload or payload[0] not in (STATUS_BIN_V1, STATUS_BIN_V2):
+        return None
+    head = 1
+    if payload[0] == STATUS_BIN_V2:
+        if len(payload) < 2 or len(payload) < 2 + payload[1]:
+            return None
+        head = 2 + payload[1]
+        try:
+            team = bytes(payload[2:head]).decode("utf-8") or team
+        except UnicodeDecodeError:
+            return None
+    size = STATUS_BIN_RECORD.size
+    body = memoryview(payload)[head:]
+    if not body or len(body) % size:
+        return None
+    out = []
+    for ts_ms, p_now, p_prev, valve in STATUS_BIN_RECORD.iter_unpack(body):
+        out.append({
+            "device_id": uid,
+            "team": team,
+            "valve_state": VALVE_STATES[valve] if valve < len(VALVE_STATES) else "unknown",
+            "ts_ms": ts_ms,
+            # float32 -> убираем хвост вида 1.2339999675
+            "pressure_now": None if p_now != p_now else round(p_now, 5),
+            "pressure_prev": None if p_prev != p_prev else round(p_prev, 5),
+        })
+    return out
+
+
+def encode_status_bin(samples, team: str = None) -> bytes:
+    # обратная операция (для тестов/бенчмарка и как референс для прошивки); team => v2
+    if team:
+        raw = team.encode("utf-8")[:255]
+        parts = [bytes((STATUS_BIN_V2, len(raw))), raw]
+    else:
+        parts = [bytes((STATUS_BIN_V1,))]
+    for ts_ms, p_now, p_prev, valve_state in samples:
+        enum = VALVE_STATES.index(valve_state) if valve_state in VALVE_STATES else 0
+        parts.append(STATUS_BIN_RECORD.pack(ts_ms, p_now, p_prev, enum))
+    return b"".join(parts)
+
+
+def subscription_topic(topic: str, group: str = None) -> str:
+    # sensors/+/status -> $share/<group>/sensors/+/status
+    if group is None:
+        group = MQTT_SHARE_GROUP
+    if not group or topic.startswith("$share/"):
+        return topic
+    return f"$share/{group}/{topic}"
+
+
 def load_devices():
     if not DEVICES_JSON.exists():
         return {}
@@ -82,14 +340,782 @@ def save_devices(devs: dict):
     os.replace(tmp, DEVICES_JSON)
 
 
+# ===================== DEVICE REGISTRY (in-memory) =====================
+_devices = {}
+_devices_dirty = 0
+_devices_lock = threading.Lock()
+_devices_write_lock = threading.Lock()
+_devices_flush_now = threading.Event()
+
+
+def init_devices():
+    global _devices, _devices_dirty
+    with _devices_lock:
+        _devices = load_devices()
+        _devices_dirty = 0
+
+
+def device_meta(device_id: str, key: str, default=None):
+    with _devices_lock:
+        return _devices.get(device_id, {}).get(key, default)
+
+
 def update_device_meta(device_id: str, **kwargs):
-    devs = load_devices()
-    d = devs.get(device_id, {})
-    d["device_id"] = device_id
-    for k, v in kwargs.items():
-        d[k] = v
-    devs[device_id] = d
-    save_devices(devs)
+    # только память; на диск уходит в flush_devices()
+    global _devices_dirty
+    with _devices_lock:
+        d = _devices.get(device_id)
+        if d is None:
+            d = _devices[device_id] = {"device_id": device_id}
+        d.update(kwargs)
+        _devices_dirty += 1
+        if _devices_dirty >= DEVICES_FLUSH_EVERY:
+            _devices_flush_now.set()
+
+
+def flush_devices() -> int:
+    # снимок под локом, запись на диск уже без него (не держим обработчики)
+    global _devices_dirty
+    with _devices_write_lock:
+        with _devices_lock:
+            changes = _devices_dirty
+            if not changes:
+                return 0
+            snapshot = {k: dict(v) for k, v in _devices.items()}
+            _devices_dirty = 0
+        try:
+            save_devices(snapshot)
+        except Exception as e:
+            print("[DEVICES] flush failed:", e)
+            with _devices_lock:
+                _devices_dirty += changes
+            return 0
+    return changes
+
+
+def _devices_flusher(stop: threading.Event):
+    while not stop.is_set():
+        _devices_flush_now.wait(DEVICES_FLUSH_SEC)
+        _devices_flush_now.clear()
+        flush_devices()
+
+
+# ===================== SPOOL =====================
+class Spool:
+    # seg-<ms>-<seq>.lp: строки line protocol через \n; пишем только в последний (активный) сегмент
+    def __init__(self, directory: Path = SPOOL_DIR, segment_bytes: int = SPOOL_SEGMENT_BYTES,
+                 max_bytes: int = SPOOL_MAX_BYTES, fsync: bool = SPOOL_FSYNC):
+        self.dir = Path(directory)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.active = None      # Path
+        self.active_fh = None
+        self.active_size = 0
+        # после рестарта всё найденное на диске считаем закрытыми сегментами
+        self.closed = sorted(self.dir.glob("seg-*.lp"))
+        self.closed_bytes = sum(p.stat().st_size for p in self.closed)
+        # отвергнутые пачки (.bad) тоже в лимите max_bytes и вытесняются первыми
+        self.bad = sorted(self.dir.glob("seg-*.bad"))
+        self.bad_bytes = sum(p.stat().st_size for p in self.bad)
+        self.stats = {"spooled_lines": 0, "dropped_segments": 0, "dropped_bytes": 0,
+                      "rejected_segments": 0, "rejected_lines": 0}
+
+    def _open_segment(self):
+        self.seq += 1
+        self.active = self.dir / f"seg-{int(time.time() * 1000):013d}-{self.seq:06d}.lp"
+        self.active_fh = open(self.active, "ab")
+        self.active_size = 0
+
+    def _close_active(self):
+        if not self.active_fh:
+            return
+        self.active_fh.flush()
+        os.fsync(self.active_fh.fileno())
+        self.active_fh.close()
+        if self.active_size:
+            self.closed.append(self.active)
+            self.closed_bytes += self.active_size
+        else:
+            self.active.unlink(missing_ok=True)
+        self.active, self.active_fh, self.active_size = None, None, 0
+
+    def _enforce_cap(self):
+        while (self.bad or self.closed) and self.closed_bytes + self.active_size + self.bad_bytes > self.max_bytes:
+            if self.bad:
+                old = self.bad.pop(0)
+            else:
+                old = self.closed.pop(0)
+            size = old.stat().st_size if old.exists() else 0
+            old.unlink(missing_ok=True)
+            if old.suffix == ".bad":
+                self.bad_bytes -= size
+            else:
+                self.closed_bytes -= size
+            self.stats["dropped_segments"] += 1
+            self.stats["dropped_bytes"] += size
+            print(f"[SPOOL] cap reached, dropped {old.name} bytes={size}")
+
+    def append(self, data: bytes, nlines: int):
+        # data — готовые строки, каждая с \n на конце
+        if not data:
+            return
+        with self.lock:
+            if self.active_fh is None:
+                self._open_segment()
+            self.active_fh.write(data)
+            self.active_fh.flush()
+            if self.fsync:
+                os.fsync(self.active_fh.fileno())
+            self.active_size += len(data)
+            self.stats["spooled_lines"] += nlines
+            if self.active_size >= self.segment_bytes:
+                self._close_active()
+            self._enforce_cap()
+
+    def oldest(self):
+        # сегмент для реплея; активный закрываем, если кроме него ничего нет
+        with self.lock:
+            if not self.closed and self.active_size:
+                self._close_active()
+            return self.closed[0] if self.closed else None
+
+    def done(self, path: Path):
+        with self.lock:
+            if path in self.closed:
+                self.closed.remove(path)
+                size = path.stat().st_size if path.exists() else 0
+                self.closed_bytes -= size
+                path.unlink(missing_ok=True)
+
+    def reject_data(self, data: bytes, nlines: int):
+        # Influx отверг пачку (400/422): откладываем в seg-*.bad, в реплей она не попадает
+        with self.lock:
+            self.seq += 1
+            bad = self.dir / f"seg-{int(time.time() * 1000):013d}-{self.seq:06d}.bad"
+            with open(bad, "ab") as fh:
+                fh.write(data)
+            self.bad.append(bad)
+            self.bad_bytes += len(data)
+            self.stats["rejected_segments"] += 1
+            self.stats["rejected_lines"] += nlines
+            self._enforce_cap()
+
+    def pending_bytes(self) -> int:
+        with self.lock:
+            return self.closed_bytes + self.active_size
+
+    def close(self):
+        with self.lock:
+            self._close_active()
+
+
+def is_influx_outage(e: Exception) -> bool:
+    # ApiException с HTTP-статусом: 5xx и 429 — временно, прочие 4xx — данные плохие.
+    # всё остальное (нет соединения, таймаут, DNS) — Influx недоступен
+    status = getattr(e, "status", None)
+    if not isinstance(status, int) or status <= 0:
+        return True
+    return status >= 500 or status == 429
+
+
+class InfluxSink:
+    # принимает готовые строки line protocol (bytes, precision=NS) в один переиспользуемый буфер
+    def __init__(self, write_api, ping, spool: Spool, batch_size: int = INFLUX_BATCH_SIZE,
+                 flush_sec: float = INFLUX_FLUSH_SEC, max_pending: int = INFLUX_MAX_PENDING):
+        self.write_api = write_api
+        self.ping = ping
+        self.spool = spool
+        self.batch_size = batch_size
+        self.flush_sec = flush_sec
+        self.max_pending = max_pending
+        self.buf = bytearray()
+        self.nlines = 0
+        self.cond = threading.Condition()
+        self.up = True
+        self.stopping = False
+        self.stopped = threading.Event()  # будит паузы реплея при close()
+        self.threads = []
+        self.stats = {"written": 0, "write_errors": 0, "rejected": 0, "replayed": 0}
+
+    def start(self):
+        for target, name in ((self._flusher, "influx-flush"), (self._replayer, "spool-replay")):
+            t = threading.Thread(target=target, name=name, daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def add_lines(self, data: bytes, nlines: int):
+        # data — одна или несколько строк, каждая с \n на конце
+        overflow = None
+        with self.cond:
+            self.buf += data
+            self.nlines += nlines
+            if self.nlines >= self.max_pending:
+                # Influx висит на таймауте, а сообщения идут — не копим в памяти
+                overflow = self._take()
+            elif self.nlines >= self.batch_size:
+                self.cond.notify()
+        if overflow:
+            self.spool.append(*overflow)
+
+    def _take(self):
+        # под self.cond; буфер очищается, но сам объект остаётся
+        data, n = bytes(self.buf), self.nlines
+        del self.buf[:]
+        self.nlines = 0
+        return data, n
+
+    def _write(self, data: bytes) -> str:
+        # "ok" | "down" (сеть, таймаут, 5xx, 429 — повторим позже) | "rejected" (4xx — повтор не поможет)
+        try:
+            self.write_api.write(
+                bucket=INFLUX_BUCKET, org=INFLUX_ORG,
+                record=data, write_precision=WritePrecision.NS
+            )
+            return "ok"
+        except Exception as e:
+            self.stats["write_errors"] += 1
+            if not is_influx_outage(e):
+                self.stats["rejected"] += 1
+                print("[INFLUX] batch rejected:", str(e)[:300])
+                return "rejected"
+            if self.up:
+                print("[INFLUX] write failed, spooling:", e)
+            self.up = False
+            return "down"
+
+    def _flush(self):
+        with self.cond:
+            data, n = self._take()
+        if not n:
+            return
+        res = self._write(data) if self.up else "down"
+        if res == "ok":
+            self.stats["written"] += n
+        elif res == "rejected":
+            self.spool.reject_data(data, n)
+        else:
+            self.spool.append(data, n)
+
+    def _flusher(self):
+        while True:
+            with self.cond:
+                if not self.stopping and self.nlines < self.batch_size:
+                    self.cond.wait(self.flush_sec)
+                stopping = self.stopping
+            self._flush()
+            if stopping:
+                return
+
+    def _replayer(self):
+        # отдельный поток: живые точки идут напрямую, backlog догоняется параллельно
+        backoff = SPOOL_PROBE_SEC
+        while not self.stopping:
+            if not self.up:
+                try:
+                    self.up = bool(self.ping())
+                except Exception:
+                    self.up = False
+                if not self.up:
+                    self.stopped.wait(SPOOL_PROBE_SEC)
+                    continue
+                print("[INFLUX] back online, replaying spool")
+
+            seg = self.spool.oldest()
+            if seg is None:
+                self.stopped.wait(SPOOL_PROBE_SEC)
+                continue
+            res = self._replay_segment(seg)
+            if res != "ok":
+                if res == "down":
+                    # ping может быть ok, а запись — нет: не долбим Influx в цикле
+                    self.stopped.wait(backoff)
+                    backoff = min(backoff * 2, SPOOL_BACKOFF_MAX_SEC)
+                continue
+            backoff = SPOOL_PROBE_SEC
+            self.spool.done(seg)
+            print(f"[SPOOL] replayed {seg.name}, left bytes={self.spool.pending_bytes()}")
+
+    def _replay_segment(self, seg: Path) -> str:
+        # при ошибке на середине сегмент повторится целиком — для Influx это перезапись тех же точек
+        chunk = []
+        with open(seg, "rb") as fh:
+            for line in fh:
+                line = line.rstrip(b"\n")
+                if line:
+                    chunk.append(line)
+                if len(chunk) >= SPOOL_REPLAY_BATCH:
+                    res = self._replay_chunk(chunk)
+                    if res != "ok":
+                        return res
+                    chunk = []
+                if self.stopping:
+                    return "stopped"
+        return self._replay_chunk(chunk) if chunk else "ok"
+
+    def _replay_chunk(self, chunk) -> str:
+        t0 = time.monotonic()
+        data = b"\n".join(chunk)
+        res = self._write(data)
+        if res == "rejected":
+            # плохая пачка — в .bad, остальной сегмент реплеится дальше
+            self.spool.reject_data(data + b"\n", len(chunk))
+            return "ok"
+        if res != "ok":
+            return res
+        self.stats["replayed"] += len(chunk)
+        if SPOOL_REPLAY_LINES_PER_SEC > 0:
+            min_dt = len(chunk) / SPOOL_REPLAY_LINES_PER_SEC
+            self.stopped.wait(max(0.0, min_dt - (time.monotonic() - t0)))
+        return "ok"
+
+    def snapshot(self) -> dict:
+        out = dict(self.stats)
+        out.update(self.spool.stats)
+        out["influx_up"] = self.up
+        out["pending"] = self.nlines
+        out["spool_bytes"] = self.spool.pending_bytes()
+        return out
+
+    def close(self, timeout: float = 10.0):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        self.stopped.set()
+        deadline = time.monotonic() + timeout
+        for t in self.threads:
+            t.join(max(0.0, deadline - time.monotonic()))
+        self._flush()  # если поток не успел — остаток в spool/Influx
+        self.spool.close()
+
+
+# ===================== DEDUP INDEX =====================
+class DedupIndex:
+    # device_id -> [set ts, deque ts, дублей]: set для проверки, deque для вытеснения старых;
+    # счётчик дублей живёт в той же LRU-записи и вытесняется вместе с ней
+    def __init__(self, window: int = DEDUP_WINDOW, max_devices: int = DEDUP_MAX_DEVICES):
+        self.window = window
+        self.max_devices = max_devices
+        self.devices = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"checked": 0, "duplicates": 0}
+
+    def seen(self, device_id: str, ts_ms: int) -> bool:
+        # True => дубль; без timestamp не сравниваем
+        if not ts_ms or self.window <= 0:
+            return False
+        with self.lock:
+            self.stats["checked"] += 1
+            entry = self.devices.get(device_id)
+            if entry is None:
+                if len(self.devices) >= self.max_devices:
+                    self.devices.popitem(last=False)
+                entry = self.devices[device_id] = [set(), deque(), 0]
+            else:
+                self.devices.move_to_end(device_id)
+            known, order = entry[0], entry[1]
+            if ts_ms in known:
+                self.stats["duplicates"] += 1
+                entry[2] += 1
+                return True
+            known.add(ts_ms)
+            order.append(ts_ms)
+            if len(order) > self.window:
+                known.discard(order.popleft())
+            return False
+
+    def filter(self, records: list) -> list:
+        return [r for r in records if not self.seen(r["device_id"], r["ts_ms"])]
+
+    def duplicates(self, device_id: str) -> int:
+        # сколько дублей отброшено по device_id (0, если устройство вытеснено из индекса)
+        with self.lock:
+            entry = self.devices.get(device_id)
+            return entry[2] if entry is not None else 0
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            out = dict(self.stats)
+            out["devices"] = len(self.devices)
+        return out
+
+
+# ===================== ROLLUP WINDOWS =====================
+def parse_windows(spec: str):
+    # "1s,10s,1m" -> [("1s", 1000), ("10s", 10000), ("1m", 60000)]
+    units = {"ms": 1, "s": 1000, "m": 60_000, "h": 3_600_000}
+    out = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        num = part.rstrip("smh")
+        unit = part[len(num):]
+        if unit not in units or not num.isdigit() or int(num) <= 0:
+            raise ValueError(f"bad rollup window: {part}")
+        out.append((part, int(num) * units[unit]))
+    return out
+
+
+class Rollups:
+    # (device_id, every_ms) -> [start_ms, team, valve_state, last, min, max, sum, count, prev_last, arrived, last_ts]
+    # окно закрывается первым sample из следующего окна или по тишине (sweep)
+    # last/prev_last/valve_state — от самого свежего по ts_ms sample, не от последнего пришедшего
+    def __init__(self, windows=None, grace_sec: float = ROLLUP_GRACE_SEC):
+        self.windows = parse_windows(ROLLUP_WINDOWS) if windows is None else windows
+        self.grace_ms = int(grace_sec * 1000)
+        self.measurements = {every: f"{MEASUREMENT}_{name}" for name, every in self.windows}
+        self.open = {}
+        self.emitted = {}  # (device_id, every_ms) -> start_ms последнего записанного окна
+        self.lock = threading.Lock()
+        self.stats = {"windows": 0, "late": 0}
+
+    def add(self, device_id: str, team: str, valve_state: str, ts_ms: int, p_now, p_prev, out: bytearray) -> int:
+        # закрытые окна дописываются в out; возвращает число строк
+        if p_now is None or not math.isfinite(p_now):
+            return 0
+        n = 0
+        arrived = time.monotonic()
+        with self.lock:
+            for _, every in self.windows:
+                start = ts_ms - ts_ms % every
+                key = (device_id, every)
+                w = self.open.get(key)
+                if w is not None and start != w[0]:
+                    if start < w[0]:
+                        self.stats["late"] += 1  # старее открытого окна — в агрегаты не попадает
+                        continue
+                    n += self._emit(key, w, out)
+                    w = None
+                if w is None:
+                    if start <= self.emitted.get(key, -1):
+                        # окно уже записано (sweep): новое с частичными агрегатами перетёрло бы его в Influx
+                        self.stats["late"] += 1
+                        continue
+                    self.open[key] = [start, team, valve_state, p_now, p_now, p_now, p_now, 1, p_prev, arrived, ts_ms]
+                    continue
+                if ts_ms >= w[10]:
+                    w[1], w[2], w[3], w[8], w[10] = team, valve_state, p_now, p_prev, ts_ms
+                if p_now < w[4]:
+                    w[4] = p_now
+                if p_now > w[5]:
+                    w[5] = p_now
+                w[6] += p_now
+                w[7] += 1
+                w[9] = arrived
+        return n
+
+    def _emit(self, key, w, out: bytearray) -> int:
+        device_id, every = key
+        start, team, valve_state, last, lo, hi, total, count, prev = w[:9]
+        fields = [
+            f"count={count}i",
+            "pressure_max=" + _lp_float(hi),
+            "pressure_mean=" + _lp_float(total / count),
+            "pressure_min=" + _lp_float(lo),
+            "pressure_now=" + _lp_float(last),
+        ]
+        if prev is not None and math.isfinite(prev):
+            fields.append("pressure_prev=" + _lp_float(prev))
+        # время точки = конец окна, как у aggregateWindow (timeSrc: "_stop")
+        ts_ns = (start + every) * 1_000_000
+        prefix = (
+            self.measurements[every].translate(_LP_ESCAPE_MEASUREMENT)
+            + _lp_tag("device_id", device_id)
+            + _lp_tag("team", team)
+            + _lp_tag("valve_state", valve_state)
+        )
+        out += f"{prefix} {','.join(fields)} {ts_ns}\n".encode("utf-8")
+        self.emitted[key] = start
+        self.stats["windows"] += 1
+        return 1
+
+    def sweep(self, out: bytearray, idle: bool = True) -> int:
+        # idle=True: закрываем окна устройств, которые молчат every+grace; False: закрываем всё (shutdown)
+        now = time.monotonic()
+        n = 0
+        with self.lock:
+            for key in list(self.open):
+                w = self.open[key]
+                if not idle or (now - w[9]) * 1000 >= key[1] + self.grace_ms:
+                    n += self._emit(key, w, out)
+                    del self.open[key]
+        return n
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            out = dict(self.stats)
+            out["open"] = len(self.open)
+        return out
+
+
+def _rollup_sweeper(rollups: Rollups, sink, stop: threading.Event):
+    while not stop.wait(ROLLUP_SWEEP_SEC):
+        buf = bytearray()
+        n = rollups.sweep(buf)
+        if n:
+            sink.add_lines(bytes(buf), n)
+
+
+# ===================== VALVE FLIPS =====================
+class ValveTracker:
+    # device_id -> (ts_ms, valve_state) последнего sample
+    def __init__(self, measurement: str = VALVE_EVENTS_MEASUREMENT):
+        self.measurement = measurement.translate(_LP_ESCAPE_MEASUREMENT)
+        self.last = {}
+        self.lock = threading.Lock()
+        self.stats = {"events": 0}
+
+    def seed(self, devices: dict):
+        # после рестарта продолжаем с состояния из devices.json, чтобы не писать ложный flip
+        with self.lock:
+            for device_id, d in devices.items():
+                if d.get("valve_state"):
+                    self.last[device_id] = (0, str(d["valve_state"]))
+
+    def add(self, device_id: str, team: str, valve_state: str, ts_ms: int, p_now, p_prev, out: bytearray) -> int:
+        with self.lock:
+            prev = self.last.get(device_id)
+            if prev is not None and ts_ms < prev[0]:
+                return 0  # запоздавший sample не должен переворачивать состояние
+            self.last[device_id] = (ts_ms, valve_state)
+            if prev is None or prev[1] == valve_state:
+                return 0
+            self.stats["events"] += 1
+
+        fields = [f'from_state="{_lp_string(prev[1])}"']
+        if p_now is not None and p_prev is not None and math.isfinite(p_now - p_prev):
+            fields.append("delta=" + _lp_float(p_now - p_prev))
+        if p_now is not None and math.isfinite(p_now):
+            fields.append("pressure_now=" + _lp_float(p_now))
+        if p_prev is not None and math.isfinite(p_prev):
+            fields.append("pressure_prev=" + _lp_float(p_prev))
+        prefix = (
+            self.measurement
+            + _lp_tag("device_id", device_id)
+            + _lp_tag("team", team)
+            + _lp_tag("valve_state", valve_state)
+        )
+        out += f"{prefix} {','.join(fields)} {ts_ms * 1_000_000}\n".encode("utf-8")
+        return 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {"events": self.stats["events"], "devices": len(self.last)}
+
+
+# ===================== LATEST STATE STORE =====================
+class LatestStore:
+    """
+    latest_state(device_id PK, team, valve_state, pressure_now, pressure_prev, ts_ms, updated_ms).
+    put() только в память (самый свежий sample на устройство), flush() — одной транзакцией.
+    """
+
+    UPSERT = (
+        "INSERT INTO latest_state (device_id, team, valve_state, pressure_now, pressure_prev, ts_ms, updated_ms)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?)"
+        " ON CONFLICT(device_id) DO UPDATE SET"
+        " team = excluded.team, valve_state = excluded.valve_state,"
+        " pressure_now = excluded.pressure_now, pressure_prev = excluded.pressure_prev,"
+        " ts_ms = excluded.ts_ms, updated_ms = excluded.updated_ms"
+        " WHERE excluded.ts_ms >= latest_state.ts_ms"
+    )
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=5.0, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")  # WAL: без fsync на каждый commit
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS latest_state ("
+            " device_id TEXT PRIMARY KEY, team TEXT, valve_state TEXT,"
+            " pressure_now REAL, pressure_prev REAL, ts_ms INTEGER NOT NULL, updated_ms INTEGER NOT NULL)"
+        )
+        self.lock = threading.Lock()
+        self.pending = {}  # device_id -> row
+        self.stats = {"flushes": 0, "rows": 0, "errors": 0}
+
+    def put(self, device_id: str, team: str, valve_state: str, ts_ms: int, p_now, p_prev):
+        with self.lock:
+            cur = self.pending.get(device_id)
+            if cur is None or ts_ms >= cur[5]:
+                self.pending[device_id] = (device_id, team, valve_state, p_now, p_prev, ts_ms, 0)
+
+    def flush(self) -> int:
+        with self.lock:
+            rows, self.pending = self.pending, {}
+        if not rows:
+            return 0
+        now_ms = int(time.time() * 1000)
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.executemany(self.UPSERT, [r[:6] + (now_ms,) for r in rows.values()])
+            self.conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            try:
+                self.conn.execute("ROLLBACK")
+            except sqlite3.Error:
+                pass
+            self.stats["errors"] += 1
+            print("[LATEST] flush failed:", e)
+            with self.lock:
+                for k, r in rows.items():  # вернуть, если за это время не пришло свежее
+                    cur = self.pending.get(k)
+                    if cur is None or r[5] > cur[5]:
+                        self.pending[k] = r
+            return 0
+        self.stats["flushes"] += 1
+        self.stats["rows"] += len(rows)
+        return len(rows)
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+def _latest_flusher(store: LatestStore, stop: threading.Event):
+    while not stop.wait(LATEST_FLUSH_SEC):
+        store.flush()
+
+
+# ===================== WORKER PIPELINE =====================
+class Pipeline:
+    def __init__(self, handler, workers: int = WORKERS, maxsize: int = QUEUE_MAX,
+                 policy: str = QUEUE_POLICY, block_sec: float = QUEUE_BLOCK_SEC):
+        if policy not in ("block", "drop_new", "drop_oldest"):
+            raise ValueError(f"unknown LISTENER_QUEUE_POLICY: {policy}")
+        self.handler = handler
+        self.maxsize = maxsize
+        self.policy = policy
+        self.block_sec = block_sec
+        self.queues = [deque() for _ in range(workers)]
+        self.conds = [threading.Condition() for _ in range(workers)]
+        self.threads = []
+        self.stopping = False
+        self.stats = {"enqueued": 0, "processed": 0, "dropped": 0, "errors": 0, "max_depth": 0}
+        self.uids = set()  # какие устройства попали на этот инстанс
+        self._stats_lock = threading.Lock()
+
+    def _count(self, key: str, n: int = 1):
+        with self._stats_lock:
+            self.stats[key] += n
+
+    def start(self):
+        for i in range(len(self.queues)):
+            t = threading.Thread(target=self._worker, args=(i,), name=f"worker-{i}", daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def partition(self, uid: str) -> int:
+        return zlib.crc32(uid.encode("utf-8", errors="replace")) % len(self.queues)
+
+    def submit(self, uid: str, kind: str, payload: bytes) -> bool:
+        i = self.partition(uid)
+        q, cond = self.queues[i], self.conds[i]
+        dropped = False
+        with cond:
+            if len(q) >= self.maxsize:
+                if self.policy == "drop_oldest":
+                    q.popleft()
+                    dropped = True
+                elif self.policy == "block":
+                    deadline = time.monotonic() + self.block_sec
+                    while len(q) >= self.maxsize and not self.stopping:
+                        left = deadline - time.monotonic()
+                        if left <= 0:
+                            break
+                        cond.wait(left)
+                if len(q) >= self.maxsize:
+                    # drop_new или block с истёкшим таймаутом
+                    self._count("dropped")
+                    return False
+            q.append((uid, kind, payload))
+            depth = len(q)
+            cond.notify_all()
+
+        with self._stats_lock:
+            self.stats["enqueued"] += 1
+            self.uids.add(uid)
+            if dropped:
+                self.stats["dropped"] += 1
+            if depth > self.stats["max_depth"]:
+                self.stats["max_depth"] = depth
+        return True
+
+    def _worker(self, i: int):
+        q, cond = self.queues[i], self.conds[i]
+        while True:
+            with cond:
+                while not q and not self.stopping:
+                    cond.wait()
+                if not q:
+                    return  # stopping и очередь пуста
+                item = q.popleft()
+                cond.notify_all()  # будим submit в режиме block
+            try:
+                self.handler(*item)
+                self._count("processed")
+            except Exception as e:
+                self._count("errors")
+                print(f"[PIPE] worker-{i} error uid={item[0]}:", e)
+
+    def depths(self):
+        return [len(q) for q in self.queues]
+
+    def snapshot(self) -> dict:
+        with self._stats_lock:
+            out = dict(self.stats)
+            out["devices"] = len(self.uids)
+            self.stats["max_depth"] = 0  # максимум за интервал
+        out["depth"] = self.depths()
+        out["capacity"] = self.maxsize
+        return out
+
+    def stop(self, timeout: float = 10.0):
+        # дорабатываем то, что уже в очередях, потом выходим
+        self.stopping = True
+        for cond in self.conds:
+            with cond:
+                cond.notify_all()
+        deadline = time.monotonic() + timeout
+        for t in self.threads:
+            t.join(max(0.0, deadline - time.monotonic()))
+
+
+def _stats_reporter(pipe: Pipeline, sink: InfluxSink, dedup: DedupIndex, rollups: Rollups,
+                    valves: ValveTracker, stop: threading.Event, publish=None):
+    while not stop.wait(STATS_SEC):
+        st = pipe.snapshot()
+        st["instance"] = INSTANCE_ID
+        st["group"] = MQTT_SHARE_GROUP or None
+        st["influx"] = sink.snapshot()
+        st["dedup"] = dedup.snapshot()
+        st["rollups"] = rollups.snapshot()
+        st["valve_events"] = valves.snapshot()
+        print(
+            f"[PIPE] {INSTANCE_ID} depth={st['depth']} max={st['max_depth']}/{st['capacity']} "
+            f"in={st['enqueued']} ok={st['processed']} dropped={st['dropped']} err={st['errors']} "
+            f"devices={st['devices']}"
+        )
+        inf = st["influx"]
+        print(
+            f"[INFLUX] up={inf['influx_up']} written={inf['written']} pending={inf['pending']} "
+            f"spooled={inf['spooled_lines']} replayed={inf['replayed']} spool_bytes={inf['spool_bytes']} "
+            f"dropped_bytes={inf['dropped_bytes']}"
+        )
+        print(
+            f"[DEDUP] checked={st['dedup']['checked']} duplicates={st['dedup']['duplicates']} | "
+            f"[ROLLUP] windows={st['rollups']['windows']} open={st['rollups']['open']} late={st['rollups']['late']} | "
+            f"[VALVE] events={st['valve_events']['events']}"
+        )
+        if publish:
+            try:
+                publish(json.dumps(st))
+            except Exception as e:
+                print("[PIPE] stats publish failed:", e)
 
 
 def save_init_html(device_id: str, html: str) -> str:
@@ -108,23 +1134,46 @@ def save_init_html(device_id: str, html: str) -> str:
 def main():
     if not INFLUX_TOKEN:
         raise SystemExit("INFLUX_TOKEN missing. Export it first.")
+    if MQTT_SHARE_GROUP and not INSTANCE_ID:
+        raise SystemExit("LISTENER_INSTANCE_ID missing: required with MQTT_SHARE_GROUP, keep it stable across restarts.")
+
+    init_devices()
+    stop = threading.Event()
+    flusher = threading.Thread(target=_devices_flusher, args=(stop,), name="devices-flush", daemon=True)
+    flusher.start()
 
     influx = InfluxDBClient(
         url=INFLUX_URL,
         token=INFLUX_TOKEN,
-        org=INFLUX_ORG
+        org=INFLUX_ORG,
+        timeout=INFLUX_TIMEOUT_MS,
     )
-    writer = influx.write_api()
+    sink = InfluxSink(influx.write_api(write_options=SYNCHRONOUS), influx.ping, Spool())
+    sink.start()
+    dedup = DedupIndex()
+    rollups = Rollups()
+    valves = ValveTracker()
+    with _devices_lock:
+        valves.seed(_devices)
+    sweeper = threading.Thread(target=_rollup_sweeper, args=(rollups, sink, stop), name="rollups", daemon=True)
+    sweeper.start()
+    store = LatestStore(LATEST_DB) if LATEST_DB else None
+    latest = None
+    if store is not None:
+        latest = threading.Thread(target=_latest_flusher, args=(store, stop), name="latest", daemon=True)
+        latest.start()
+        print(f"[LATEST] state -> {LATEST_DB}")
+    if sink.spool.pending_bytes():
+        print(f"[SPOOL] found backlog bytes={sink.spool.pending_bytes()} in {sink.spool.dir}")
 
     def on_connect(client, userdata, flags, rc, properties=None):
         print(f"[MQTT] connected rc={rc}")
 
-        # подписка на status + init
-        client.subscribe(MQTT_TOPIC_STATUS)
-        client.subscribe(MQTT_TOPIC_INIT)
-
-        print(f"[MQTT] subscribed: {MQTT_TOPIC_STATUS}")
-        print(f"[MQTT] subscribed: {MQTT_TOPIC_INIT}")
+        # подписка на status + init (через $share, если задана группа)
+        for topic in (MQTT_TOPIC_STATUS, MQTT_TOPIC_STATUS_BIN, MQTT_TOPIC_INIT):
+            sub = subscription_topic(topic)
+            client.subscribe(sub)
+            print(f"[MQTT] subscribed: {sub}")
 
     def handle_init(uid: str, raw: str):
         # лимит по размеру
@@ -151,52 +1200,135 @@ def main():
             update_device_meta(uid, last_seen_utc=int(time.time()), last_error="bad_json")
             return
 
-        device_id = str(data.get("device_id") or uid or "unknown")
-        team = str(data.get("team", "unknown"))
-        valve_state = str(data.get("valve_state", "unknown"))
+        samples = status_samples(data)
+        if not samples:
+            print("[MQTT] bad status payload:", raw[:200])
+            update_device_meta(uid, last_seen_utc=int(time.time()), last_error="bad_payload")
+            return
+        if len(samples) > MAX_STATUS_SAMPLES:
+            print(f"[MQTT] status batch too large uid={uid} n={len(samples)}, keeping last {MAX_STATUS_SAMPLES}")
+            samples = samples[-MAX_STATUS_SAMPLES:]
 
-        ts_ms = to_int(data.get("timestamp_ms") or data.get("timestamp"))
-        if 0 < ts_ms < 10_000_000_000:
-            ts_ms *= 1000
+        write_status(uid, [parse_status_record(uid, d) for d in samples], raw)
 
-        pressure_now = to_float(data.get("pressure_now"))
-        pressure_prev = to_float(data.get("pressure_30ms_ago") or data.get("pressure_prev"))
+    def write_status(uid: str, records: list, raw: str):
+        total = len(records)
+        batch = records
+        records = dedup.filter(records)
+        if len(records) < total:
+            dups = total - len(records)
+            # счётчик ведётся по device_id из payload — по нему же и в реестр
+            kept = set(map(id, records))
+            for device_id in {r["device_id"] for r in batch if id(r) not in kept}:
+                update_device_meta(device_id, last_seen_utc=int(time.time()), dup_dropped=dedup.duplicates(device_id))
+            if not records:
+                print(f"[DUP] {uid} dropped={dups}")
+                return
 
-        point = (
-            Point(MEASUREMENT)
-            .tag("device_id", device_id)
-            .tag("team", team)
-            .tag("valve_state", valve_state)
-        )
+        # вся пачка -> один кусок line protocol в sink
+        buf = bytearray()
+        n = 0
+        now_ns = time.time_ns()
+        for i, r in enumerate(records):
+            # без timestamp — время приёма (+i нс, чтобы точки пачки не перетёрли друг друга)
+            ts_ns = r["ts_ms"] * 1_000_000 if r["ts_ms"] else now_ns + i
+            line = encode_status_line(
+                r["device_id"], r["team"], r["valve_state"], r["pressure_now"], r["pressure_prev"], ts_ns
+            )
+            if line:
+                buf += line
+                n += 1
+            n += rollups.add(
+                r["device_id"], r["team"], r["valve_state"], ts_ns // 1_000_000, r["pressure_now"], r["pressure_prev"], buf
+            )
+            if VALVE_EVENTS:
+                n += valves.add(
+                    r["device_id"], r["team"], r["valve_state"], ts_ns // 1_000_000,
+                    r["pressure_now"], r["pressure_prev"], buf
+                )
+        if n:
+            sink.add_lines(bytes(buf), n)
 
-        if pressure_now is not None:
-            point = point.field("pressure_now", pressure_now)
-        if pressure_prev is not None:
-            point = point.field("pressure_prev", pressure_prev)
-        if pressure_now is not None and pressure_prev is not None:
-            point = point.field("pressure_delta", pressure_now - pressure_prev)
+        # мета для overview/offline — по самому свежему sample каждого устройства
+        latest = {}
+        for r in records:
+            cur = latest.get(r["device_id"])
+            if cur is None or r["ts_ms"] >= cur["ts_ms"]:
+                latest[r["device_id"]] = r
+        now_ms = int(time.time() * 1000)
+        for device_id, r in latest.items():
+            if store is not None:
+                store.put(device_id, r["team"], r["valve_state"], r["ts_ms"] or now_ms,
+                          r["pressure_now"], r["pressure_prev"])
+            update_device_meta(
+                device_id,
+                team=r["team"],
+                valve_state=r["valve_state"],
+                pressure_now=r["pressure_now"],
+                pressure_prev=r["pressure_prev"],
+                last_seen_utc=int(time.time()),
+                last_status_raw=raw[:4000]  # защита
+            )
 
-        if ts_ms:
-            point = point.time(ts_ms, WritePrecision.MS)
+        if total == 1:
+            r = records[0]
+            print(f"[OK] {r['device_id']} valve={r['valve_state']} now={r['pressure_now']} prev={r['pressure_prev']}")
         else:
-            point = point.time(now_utc(), WritePrecision.NS)
+            print(f"[OK] {uid} batch={total} lines={n} dup={total - len(records)}")
 
-        writer.write(bucket=INFLUX_BUCKET, org=INFLUX_ORG, record=point)
+    def handle_status_bin(uid: str, payload: bytes):
+        team = device_meta(uid, "team") or DEFAULT_TEAM or None
+        records = decode_status_bin(uid, payload, team)
+        if not records:
+            print(f"[MQTT] bad status.bin uid={uid} bytes={len(payload)} head={payload[:8].hex()}")
+            update_device_meta(uid, last_seen_utc=int(time.time()), last_error="bad_bin")
+            return
+        if records[0]["team"] is None:
+            # v1 от устройства, чей team ещё неизвестен: не пишем под "unknown" (скрыто фильтром дашборда)
+            skipped = (device_meta(uid, "bin_no_team", 0) or 0) + len(records)
+            print(f"[MQTT] status.bin without team uid={uid} n={len(records)}, skipped total={skipped}")
+            update_device_meta(uid, last_seen_utc=int(time.time()), last_error="no_team", bin_no_team=skipped)
+            return
+        if len(records) > MAX_STATUS_SAMPLES:
+            print(f"[MQTT] status batch too large uid={uid} n={len(records)}, keeping last {MAX_STATUS_SAMPLES}")
+            records = records[-MAX_STATUS_SAMPLES:]
 
-        # мета для overview/offline
-        update_device_meta(
-            device_id,
-            team=team,
-            valve_state=valve_state,
-            pressure_now=pressure_now,
-            pressure_prev=pressure_prev,
-            last_seen_utc=int(time.time()),
-            last_status_raw=raw[:4000]  # защита
-        )
+        write_status(uid, records, f"<status.bin v{payload[0]} n={len(records)}>")
+
+    def handle_message(uid: str, kind: str, payload: bytes):
+        # выполняется в воркере
+        if kind == "status.bin":
+            handle_status_bin(uid, payload)
+            return
+
+        raw = payload.decode("utf-8", errors="replace")
+
+        if kind == "init":
+            handle_init(uid, raw)
+        elif kind == "status":
+            handle_status(uid, raw)
+
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=INSTANCE_ID)
 
-        print(f"[OK] {device_id} valve={valve_state} now={pressure_now} prev={pressure_prev}")
+    def publish_stats(payload: str):
+        client.publish(MQTT_STATS_TOPIC.format(instance=INSTANCE_ID), payload, qos=0, retain=False)
+
+    pipe = Pipeline(handle_message)
+    pipe.start()
+    reporter = threading.Thread(
+        target=_stats_reporter,
+        args=(pipe, sink, dedup, rollups, valves, stop, publish_stats if MQTT_STATS_TOPIC else None),
+        name="stats",
+        daemon=True,
+    )
+    reporter.start()
+    print(
+        f"[PIPE] instance={INSTANCE_ID} group={MQTT_SHARE_GROUP or '-'} "
+        f"workers={len(pipe.queues)} queue_max={pipe.maxsize} policy={pipe.policy}"
+    )
 
     def on_message(client, userdata, msg):
+        # сетевой поток paho: никакой тяжёлой работы здесь
         uid, kind = parse_topic(msg.topic)
         if not uid:
             # fallback: если topic не стандартный — пробуем json device_id
@@ -204,19 +1336,33 @@ def main():
             print("[MQTT] unknown topic:", msg.topic, "payload:", raw[:120])
             return
 
-        raw = msg.payload.decode("utf-8", errors="replace")
-
-        if kind == "init":
-            handle_init(uid, raw)
-        elif kind == "status":
-            handle_status(uid, raw)
+        pipe.submit(uid, kind, msg.payload)
 
-    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
     client.on_connect = on_connect
     client.on_message = on_message
 
+    # SIGTERM (systemd/docker) -> выходим из loop_forever и чисто сбрасываем devices.json
+    signal.signal(signal.SIGTERM, lambda *_: client.disconnect())
+
     client.connect(MQTT_HOST, MQTT_PORT, keepalive=30)
-    client.loop_forever()
+    try:
+        client.loop_forever()
+    finally:
+        pipe.stop()
+        stop.set()
+        _devices_flush_now.set()
+        flusher.join(timeout=5)
+        n = flush_devices()
+        tail = bytearray()
+        n_tail = rollups.sweep(tail, idle=False)  # незакрытые окна; сначала sweep, потом bytes(tail)
+        sink.add_lines(bytes(tail), n_tail)
+        sink.close()
+        influx.close()
+        if store is not None:
+            # flusher может быть внутри flush() на том же соединении: дождаться, потом финальный flush + close
+            latest.join(timeout=5)
+            store.close()
+        print(f"[DEVICES] final flush changes={n}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,409 @@
+"""
+app.py tests without a real Influx:  python -m pytest -q
+"""
+
+import asyncio
+import gzip
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+os.environ.setdefault("INFLUX_TOKEN", "test")
+
+import pytest
+
+import app
+import listener
+
+
+# -------- Fakes --------
+class FakeClock:
+    """time module stand-in: time() is driven by the test, the rest is the real module."""
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class FakeRecord:
+    def __init__(self, t_ms, value=None, **values):
+        self._t = datetime.fromtimestamp(t_ms / 1000, tz=timezone.utc)
+        self._value = value
+        self.values = values
+
+    def get_time(self):
+        return self._t
+
+    def get_value(self):
+        return self._value
+
+    def get_field(self):
+        return self.values.get("_field")
+
+
+class FakeTable:
+    def __init__(self, records):
+        self.records = records
+
+
+class FakeHistoryInflux:
+    """
+    A sample every 400 ms; the valve flips every 37 s. Answers the three history
+    queries like aggregateWindow(fn: last): windows aligned to the epoch, cut by
+    range start, stamped at their end (clipped to now).
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+
+    def sample(self, t_ms):
+        n = t_ms // 400
+        state = "open" if (t_ms // 37_000) % 2 == 0 else "closed"
+        return {"pressure_now": float(n % 101), "pressure_prev": float((n - 1) % 101), "valve_state": state}
+
+    def _start_ms(self, q):
+        start = re.search(r"range\(start: ([^)]+)\)", q).group(1)
+        m = re.fullmatch(r"-(\d+)h", start)
+        if m:
+            return int(self.clock.now * 1000) - int(m.group(1)) * 3600 * 1000
+        return int(datetime.strptime(start, "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+    def _windows(self, start_ms, every_ms):
+        now_ms = int(self.clock.now * 1000)
+        first = -(-start_ms // 400) * 400
+        last = {}
+        for t in range(first, now_ms + 1, 400):
+            last[t - t % every_ms] = t
+        return [(min(w + every_ms, now_ms), self.sample(t)) for w, t in sorted(last.items())]
+
+    def query(self, q):
+        start_ms = self._start_ms(q)
+        if "pivot(" in q:
+            rows = self._windows(start_ms, 1000)
+            return [FakeTable([FakeRecord(t, **s) for t, s in rows])]
+        if '"valve_state"])' in q:
+            rows = self._windows(start_ms, 1000)
+            return [FakeTable([FakeRecord(t, valve_state=s["valve_state"]) for t, s in rows])]
+        rows = self._windows(start_ms, app._HISTORY_WIN_CHART_MS)
+        return [FakeTable([FakeRecord(t, s["pressure_now"]) for t, s in rows])]
+
+
+class FakeLatestInflux:
+    """
+    Points (device, t_ms) become visible at t_ms + lag; answers the latest query
+    (range start, group by device_id/_field, last()) like Flux does.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.queries = []
+        self.devices = {}  # device_id -> (first_ms, last_ms, step_ms, lag_ms)
+
+    def points(self):
+        now_ms = int(self.clock.now * 1000)
+        for uid, (first, last, step, lag) in self.devices.items():
+            for t in range(first, min(last, now_ms - lag) + 1, step):
+                yield uid, t
+
+    def query(self, q):
+        self.queries.append(q)
+        start = re.search(r"range\(start: ([^)]+)\)", q).group(1)
+        m = re.fullmatch(r"-(\d+)m", start)
+        if m:
+            start_ms = int(self.clock.now * 1000) - int(m.group(1)) * 60_000
+        else:
+            start_ms = int(datetime.strptime(start, "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=timezone.utc).timestamp() * 1000)
+        last = {}
+        for uid, t in self.points():
+            if t >= start_ms:
+                last[uid] = max(last.get(uid, t), t)
+        tables = []
+        for uid, t in sorted(last.items()):
+            state = "open" if (t // 7_000) % 2 else "closed"
+            for field, v in (("pressure_now", t % 97), ("pressure_prev", t % 89)):
+                tables.append(FakeTable([FakeRecord(t, float(v), device_id=uid, valve_state=state, _field=field)]))
+        return tables
+
+
+@pytest.fixture
+def fake_history(monkeypatch):
+    clock = FakeClock(1_700_000_000.25)
+    influx = FakeHistoryInflux(clock)
+    monkeypatch.setattr(app, "time", clock)
+    monkeypatch.setattr(app, "HISTORY_FROM_INGEST", False)
+    monkeypatch.setattr(app, "HISTORY_CACHE_MAX_POINTS", 300_000)
+    monkeypatch.setattr(app, "HISTORY_CACHE_FRESH_SEC", 0)
+    monkeypatch.setattr(app, "_influx_query_many", lambda qs: [influx.query(q) for q in qs])
+    app._history_cache.clear()
+    yield clock
+    app._history_cache.clear()
+
+
+def _state_at(valve_points, t):
+    st = None
+    for p in valve_points:
+        if p["t"] > t:
+            break
+        st = p["state"]
+    return st
+
+
+# -------- history cache --------
+def test_cached_history_equals_fresh(fake_history):
+    clock = fake_history
+    app.load_device_history("dev1", hours=1, limit_events=500)
+    for step in (3.4, 0.7, 7.9, 12.0, 41.3, 1.1, 95.5, 5.25, 250.0):
+        clock.now += step
+        cached = app.load_device_history("dev1", hours=1, limit_events=500)
+        assert cached["counts"]["cache"] == "hit"
+        # fresh load next to the cache, then keep growing the cached entry by tails
+        saved = dict(app._history_cache)
+        app._history_cache.clear()
+        fresh = app.load_device_history("dev1", hours=1, limit_events=500)
+        assert fresh["counts"]["cache"] == "miss"
+        app._history_cache.clear()
+        app._history_cache.update(saved)
+        assert cached["events"] == fresh["events"]
+        assert cached["pressure_points"] == fresh["pressure_points"]
+        # the head of the timeline is clamped to range start, compare the state it gives
+        for p in fresh["pressure_points"]:
+            assert _state_at(cached["valve_points"], p["t"]) == _state_at(fresh["valve_points"], p["t"])
+
+
+def test_no_flip_at_range_start(fake_history):
+    data = app.load_device_history("dev1", hours=1, limit_events=500)
+    head_ms = int(fake_history.now * 1000) - 3600 * 1000
+    states = [e["valve_state"] for e in reversed(data["events"])]
+    assert all(a != b for a, b in zip(states, states[1:]))
+    # flips every 37 s: the first one is at most one flip (+ start alignment) after range start
+    assert data["events"][-1]["time_ms"] - head_ms <= 48_000
+
+
+def test_downsample_keeps_flips_endpoints_and_budget():
+    points = [{"t": 1_000 * i, "v": float((i * 37) % 101)} for i in range(5_000)]
+    flips = [123_456, 2_000_000, 4_321_999]
+    out = app.downsample_pressure(points, 300, flips)
+    assert len(out) <= 300
+    assert out[0] == points[0] and out[-1] == points[-1]
+    ts = [p["t"] for p in out]
+    assert ts == sorted(ts)
+    # the samples on both sides of every flip are there, unchanged
+    for f in flips:
+        i = next(k for k, p in enumerate(points) if p["t"] >= f)
+        assert points[i - 1] in out and points[i] in out
+    assert app.downsample_pressure(points[:200], 300, flips) == points[:200]
+
+
+# -------- device page cache --------
+def test_device_page_cache_keyed_by_uid(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "TEMPLATES_DIR", tmp_path)
+    app._page_cache.clear()
+    (tmp_path / "dev1.html").write_text("<div>fragment</div>", encoding="utf-8")
+    with app.app.app_context():
+        # "dev!1" maps to the same fragment file but must not serve (or poison) the dev1 page
+        other, _ = app.device_page("dev!1")
+        page, _ = app.device_page("dev1")
+        again, _ = app.device_page("dev1")
+    assert b"dev!1" in other
+    assert b"dev!1" not in page
+    assert again == page
+    app._page_cache.clear()
+
+
+def test_device_page_respects_gzip_q_values(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "TEMPLATES_DIR", tmp_path)
+    app._page_cache.clear()
+    (tmp_path / "dev1.html").write_text("<div>fragment</div>", encoding="utf-8")
+    with app.app.app_context():
+        plain, _ = app.device_page("dev1")
+        for ae in ("gzip", "deflate, GZIP;q=0.5", "*"):
+            body, headers = app.device_page("dev1", ae)
+            assert headers["Content-Encoding"] == "gzip", ae
+            assert gzip.decompress(body) == plain
+        for ae in ("", "gzip;q=0", "identity, *;q=0", "br"):
+            body, headers = app.device_page("dev1", ae)
+            assert "Content-Encoding" not in headers, ae
+            assert body == plain
+    app._page_cache.clear()
+
+
+# -------- export --------
+def test_export_limit_and_order_are_global(monkeypatch):
+    queries = []
+    monkeypatch.setattr(app, "_influx_query_stream", lambda q: queries.append(q) or iter(()))
+    list(app.build_export({"uid": "a,b", "hours": "1", "limit": "10", "format": "ndjson"})[0])
+    q = queries[0]
+    # limit after a single-table sort, not per device table
+    assert q.index("|> group() ") < q.index('sort(columns: ["_time","device_id"]') < q.index("limit(n: 10)")
+
+
+# -------- latest-state store --------
+def _latest_db(path, updated_ms):
+    # the listener's own table and upsert, with a chosen write time
+    store = listener.LatestStore(path)
+    store.conn.execute(store.UPSERT, ("dev1", "t1", "open", 1.0, 0.5, updated_ms, updated_ms))
+    store.close()
+
+
+@pytest.mark.parametrize("age_sec, used", [(5, True), (3600, False)])
+def test_auto_mode_skips_stale_store(tmp_path, monkeypatch, age_sec, used):
+    db = tmp_path / "latest_state.db"
+    _latest_db(db, int((time.time() - age_sec) * 1000))
+    monkeypatch.setattr(app, "LATEST_SOURCE", "auto")
+    monkeypatch.setattr(app, "LATEST_DB_PATH", db)
+    monkeypatch.setattr(app, "LATEST_STORE_STALE_SEC", 300)
+    monkeypatch.setitem(app._store, "conn", None)
+    monkeypatch.setitem(app._store, "checked_ts", 0.0)
+    assert app._use_latest_store() is used
+    assert app.latest_store_stats()["stale"] is (not used)
+    if app._store["conn"] is not None:
+        app._store["conn"].close()
+
+
+# -------- SSE --------
+def test_first_subscriber_gets_full_snapshot(monkeypatch):
+    devices = [{"device_id": "dev1", "valve_state": "open"}]
+    monkeypatch.setattr(app, "_use_latest_store", lambda: False)
+    monkeypatch.setattr(app, "load_latest_devices", lambda: devices)
+    monkeypatch.setitem(app._sse_state, "devices", None)
+    monkeypatch.setitem(app._sse_state, "full", None)
+    monkeypatch.setitem(app._sse_state, "ring", app.deque(maxlen=10))
+
+    client, initial = app._sse_subscribe()
+    try:
+        assert initial == []
+        first = client.queue.get(timeout=5)
+        second = client.queue.get(timeout=5)
+    finally:
+        app._sse_unsubscribe(client)
+    assert b"\nevent: devices\n" in first
+    assert b'"dev1"' in first
+    assert b"event: delta" in second
+
+
+# -------- latest devices --------
+class CountingLatest:
+    """_load_latest_devices_from_influx stand-in: counts calls, blocks until released."""
+
+    def __init__(self):
+        self.calls = 0
+        self.release = threading.Event()
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            self.calls += 1
+            n = self.calls
+        assert self.release.wait(5)
+        return [{"device_id": "dev1", "refresh": n}]
+
+
+@pytest.fixture
+def counting_latest(monkeypatch):
+    stub = CountingLatest()
+    monkeypatch.setattr(app, "_use_latest_store", lambda: False)
+    monkeypatch.setattr(app, "CACHE_WARM_SEC", 0)
+    monkeypatch.setattr(app, "_latest_cache", {"ts": 0.0, "data": None, "error": None, "refreshing": False,
+                                               "read_ts": 0.0, "took": 0.0, "warm_thread": None})
+    monkeypatch.setattr(app, "_latest_stats", dict.fromkeys(app._latest_stats, 0))
+    monkeypatch.setattr(app, "_load_latest_devices_from_influx", stub)
+    return stub
+
+
+def _call_concurrently(fn, n=16):
+    # n callers released together; returns futures (the pool is not waited on here)
+    barrier = threading.Barrier(n)
+    pool = ThreadPoolExecutor(n)
+    futures = [pool.submit(lambda: (barrier.wait(), fn())[1]) for _ in range(n)]
+    pool.shutdown(wait=False)
+    return futures
+
+
+@pytest.mark.parametrize("cached", [None, "expired"])
+def test_cold_or_expired_cache_makes_one_query(counting_latest, cached):
+    if cached:
+        app._latest_cache["data"] = [{"device_id": "dev1", "refresh": 0}]
+        app._latest_cache["ts"] = time.time() - app.CACHE_TTL_SEC - app.CACHE_STALE_SEC - 10
+    futures = _call_concurrently(app.load_latest_devices)
+    time.sleep(0.2)   # everyone is waiting on the one query
+    counting_latest.release.set()
+    results = [f.result(timeout=5) for f in futures]
+    assert counting_latest.calls == 1
+    assert all(r == [{"device_id": "dev1", "refresh": 1}] for r in results)
+
+
+def test_stale_cache_served_while_one_refresh_runs(counting_latest):
+    old = [{"device_id": "dev1", "refresh": 0}]
+    app._latest_cache["data"] = old
+    app._latest_cache["ts"] = time.time() - app.CACHE_TTL_SEC - 0.1
+    futures = _call_concurrently(app.load_latest_devices)
+    # answered from the old snapshot without waiting for the (still blocked) refresh
+    assert all(f.result(timeout=2) is old for f in futures)
+    assert counting_latest.calls == 1
+    counting_latest.release.set()
+    deadline = time.time() + 5
+    while app._latest_cache["refreshing"] and time.time() < deadline:
+        time.sleep(0.01)
+    assert app.load_latest_devices() == [{"device_id": "dev1", "refresh": 1}]
+    assert counting_latest.calls == 1
+def test_incremental_latest_equals_full_scan(monkeypatch):
+    clock = FakeClock(1_700_000_000.0)
+    influx = FakeLatestInflux(clock)
+    now_ms = int(clock.now * 1000)
+    influx.devices = {
+        "dev1": (now_ms - 900_000, 10**15, 1_000, 0),
+        "dev2": (now_ms - 900_000, now_ms + 20_000, 1_000, 0),   # silent after 20 s, leaves the range later
+        "dev3": (now_ms + 200_000, 10**15, 2_000, 0),             # shows up mid-way
+        "dev4": (now_ms - 900_000, 10**15, 1_000, 3_000),         # written 3 s late (inside the overlap)
+    }
+    monkeypatch.setattr(app, "time", clock)
+    monkeypatch.setattr(app, "INFLUX_RANGE", "-10m")
+    monkeypatch.setattr(app, "_INFLUX_RANGE_SEC", 600)
+    monkeypatch.setattr(app, "LATEST_QUERY_MODE", "incremental")
+    monkeypatch.setattr(app, "LATEST_FULL_SEC", 60)
+    monkeypatch.setattr(app, "LATEST_OVERLAP_SEC", 5)
+    monkeypatch.setattr(app, "_influx_query", influx.query)
+    monkeypatch.setattr(app, "has_init_template", lambda uid: False)
+    monkeypatch.setattr(app, "_latest_state", {"devices": None, "hw": None, "full_ts": 0.0,
+                                               "full_queries": 0, "incremental_queries": 0})
+
+    seen_dev2 = False
+    for _ in range(400):   # ~13 min in 2 s steps: several full rescans, dev2 goes silent and drops out
+        clock.now += 2.0
+        cached = app._load_latest_devices_from_influx()
+        held = app._latest_state
+        app._latest_state = {"devices": None, "hw": None, "full_ts": 0.0, "full_queries": 0, "incremental_queries": 0}
+        fresh = app._load_latest_devices_from_influx()
+        app._latest_state = held
+        assert cached == fresh
+        seen_dev2 = seen_dev2 or any(d["device_id"] == "dev2" for d in cached)
+
+    assert seen_dev2 and all(d["device_id"] != "dev2" for d in cached)
+    assert {d["device_id"] for d in cached} == {"dev1", "dev3", "dev4"}
+    # one full scan per LATEST_FULL_SEC, incremental in between
+    assert 13 <= held["full_queries"] <= 15
+    assert held["incremental_queries"] == 400 - held["full_queries"]
+
+
+# -------- routes --------
+def test_history_bad_query_param_is_400():
+    resp = app.app.test_client().get("/api/device/dev1/history?hours=x")
+    assert resp.status_code == 400 and resp.get_json()["ok"] is False
+
+
+def test_asgi_history_bad_query_param_is_400():
+    asgi = pytest.importorskip("asgi")
+    from starlette.requests import Request
+
+    scope = {"type": "http", "method": "GET", "path": "/api/device/dev1/history", "headers": [],
+             "query_string": b"limit=x", "path_params": {"uid": "dev1"}}
+    resp = asyncio.run(asgi.api_device_history(Request(scope)))
+    assert resp.status_code == 400
@@ -0,0 +1,313 @@
+"""
+listener.py tests without a real Influx / MQTT broker:  python -m pytest -q
+"""
+
+import os
+import json
+import time
+import types
+
+os.environ.setdefault("INFLUX_TOKEN", "test")
+
+import pytest
+from influxdb_client.rest import ApiException
+
+import listener
+
+
+# -------- Fakes --------
+class FakeWriteApi:
+    """
+    Rejects (HTTP 400) any batch containing b"bad", fails with a connection error while down.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.lines = []
+        self.down = False
+
+    def write(self, bucket, org, record, write_precision):
+        self.calls += 1
+        if self.down:
+            raise ConnectionError("connection refused")
+        if b"bad" in record:
+            raise ApiException(status=400, reason="Bad Request")
+        self.lines.extend(record.rstrip(b"\n").split(b"\n"))
+
+
+class FakeInflux:
+    last = None
+
+    def __init__(self, *args, **kwargs):
+        self.api = FakeWriteApi()
+        FakeInflux.last = self
+
+    def write_api(self, write_options=None):
+        return self.api
+
+    def ping(self):
+        return True
+
+    def close(self):
+        pass
+
+
+class FakeMqttClient:
+    """
+    Stub broker connection: records subscriptions/publishes; loop_forever() connects,
+    delivers `inbox`, waits for a stats publish and returns (as after disconnect()).
+    """
+
+    inbox = []
+    last = None
+
+    def __init__(self, api_version, client_id=""):
+        self.client_id = client_id
+        self.subscribed = []
+        self.published = []
+        FakeMqttClient.last = self
+
+    def connect(self, host, port, keepalive=60):
+        pass
+
+    def subscribe(self, topic):
+        self.subscribed.append(topic)
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.published.append((topic, payload, retain))
+
+    def disconnect(self):
+        pass
+
+    def loop_forever(self):
+        self.on_connect(self, None, {}, 0)
+        for topic, payload in self.inbox:
+            self.on_message(self, None, types.SimpleNamespace(topic=topic, payload=payload))
+        wait_for(lambda: self.published)
+
+
+def wait_for(cond, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if cond():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+# -------- InfluxSink / Spool --------
+def test_outage_classification():
+    assert listener.is_influx_outage(ConnectionError("refused"))
+    assert listener.is_influx_outage(ApiException(status=503))
+    assert listener.is_influx_outage(ApiException(status=429))
+    assert not listener.is_influx_outage(ApiException(status=400))
+    assert not listener.is_influx_outage(ApiException(status=422))
+
+
+def test_rejected_spool_chunk_is_set_aside(tmp_path, monkeypatch):
+    monkeypatch.setattr(listener, "SPOOL_REPLAY_BATCH", 2)
+    monkeypatch.setattr(listener, "SPOOL_REPLAY_LINES_PER_SEC", 0)
+    monkeypatch.setattr(listener, "SPOOL_PROBE_SEC", 0.05)
+    spool = listener.Spool(tmp_path)
+    spool.append(b"m v=1 1\nm v=2 2\nm bad 3\nm v=4 4\nm v=5 5\n", 5)
+
+    api = FakeWriteApi()
+    sink = listener.InfluxSink(api, lambda: True, spool, flush_sec=0.05)
+    sink.start()
+    try:
+        assert wait_for(lambda: spool.pending_bytes() == 0)
+    finally:
+        sink.close()
+
+    assert api.lines == [b"m v=1 1", b"m v=2 2", b"m v=5 5"]
+    assert api.calls == 3
+    bad = list(tmp_path.glob("seg-*.bad"))
+    assert len(bad) == 1 and bad[0].read_bytes() == b"m bad 3\nm v=4 4\n"
+    assert spool.stats["rejected_lines"] == 2
+    assert sink.up
+
+
+def test_rejected_live_batch_does_not_mark_influx_down(tmp_path):
+    spool = listener.Spool(tmp_path)
+    api = FakeWriteApi()
+    sink = listener.InfluxSink(api, lambda: True, spool, flush_sec=0.05)
+    sink.add_lines(b"m bad 1\n", 1)
+    sink._flush()
+    sink.add_lines(b"m v=2 2\n", 1)
+    sink._flush()
+    assert sink.up
+    assert api.lines == [b"m v=2 2"]
+    assert spool.pending_bytes() == 0
+    assert len(list(tmp_path.glob("seg-*.bad"))) == 1
+
+
+def test_failed_replay_backs_off(tmp_path, monkeypatch):
+    # ping says ok, writes keep failing: replay must not spin
+    monkeypatch.setattr(listener, "SPOOL_PROBE_SEC", 0.05)
+    monkeypatch.setattr(listener, "SPOOL_BACKOFF_MAX_SEC", 0.4)
+    spool = listener.Spool(tmp_path)
+    spool.append(b"m v=1 1\n", 1)
+    api = FakeWriteApi()
+    api.down = True
+    sink = listener.InfluxSink(api, lambda: True, spool, flush_sec=0.05)
+    sink.start()
+    time.sleep(1.0)
+    sink.close()
+    assert 1 <= api.calls <= 10
+    assert spool.pending_bytes() > 0
+
+
+def test_close_interrupts_replay_wait(tmp_path, monkeypatch):
+    monkeypatch.setattr(listener, "SPOOL_PROBE_SEC", 30)
+    sink = listener.InfluxSink(FakeWriteApi(), lambda: True, listener.Spool(tmp_path), flush_sec=0.05)
+    sink.start()
+    time.sleep(0.1)
+    t0 = time.monotonic()
+    sink.close()
+    assert time.monotonic() - t0 < 2
+
+
+# -------- MQTT shared group --------
+def test_subscription_topic():
+    assert listener.subscription_topic("sensors/+/status", "") == "sensors/+/status"
+    assert listener.subscription_topic("sensors/+/status", "ingest") == "$share/ingest/sensors/+/status"
+    assert listener.subscription_topic("$share/g/sensors/+/init", "ingest") == "$share/g/sensors/+/init"
+
+
+@pytest.fixture
+def group_listener(tmp_path, monkeypatch):
+    monkeypatch.setattr(listener, "MQTT_SHARE_GROUP", "ingest")
+    monkeypatch.setattr(listener, "INSTANCE_ID", "node-a")
+    monkeypatch.setattr(listener, "DEVICES_JSON", tmp_path / "devices.node-a.json")
+    monkeypatch.setattr(listener, "LATEST_DB", "")
+    monkeypatch.setattr(listener, "STATS_SEC", 0.05)
+    monkeypatch.setattr(listener, "SPOOL_PROBE_SEC", 0.05)
+    spool_cls = listener.Spool
+    monkeypatch.setattr(listener, "Spool", lambda: spool_cls(tmp_path / "spool"))
+    monkeypatch.setattr(listener, "InfluxDBClient", FakeInflux)
+    monkeypatch.setattr(listener.mqtt, "Client", FakeMqttClient)
+    monkeypatch.setattr(listener.signal, "signal", lambda *a: None)
+    FakeMqttClient.inbox = []
+    return tmp_path
+
+
+def test_group_wiring(group_listener):
+    FakeMqttClient.inbox = [("sensors/dev1/status", b'{"team": "t1", "valve_state": "open", "pressure_now": 1.5}')]
+    listener.main()
+    client = FakeMqttClient.last
+
+    assert client.client_id == "node-a"
+    assert client.subscribed == [
+        "$share/ingest/sensors/+/status",
+        "$share/ingest/sensors/+/status.bin",
+        "$share/ingest/sensors/+/init",
+    ]
+    # live stats are never retained
+    stats = [(p, r) for t, p, r in client.published if t == "listeners/node-a/stats"]
+    assert stats and not any(r for _, r in stats)
+    assert json.loads(stats[0][0])["group"] == "ingest"
+    # registry survives restarts under the stable id
+    assert "dev1" in json.loads((group_listener / "devices.node-a.json").read_text(encoding="utf-8"))
+
+
+def test_group_requires_instance_id(group_listener, monkeypatch):
+    monkeypatch.setattr(listener, "INSTANCE_ID", "")
+    with pytest.raises(SystemExit):
+        listener.main()
+
+
+# -------- Rollups --------
+def test_rollup_last_follows_sample_time():
+    rollups = listener.Rollups(windows=[("10s", 10_000)])
+    out = bytearray()
+    rollups.add("dev1", "t1", "open", 1_005, 5.0, 4.0, out)
+    rollups.add("dev1", "t1", "closed", 1_009, 9.0, 8.0, out)
+    # out of order inside the same window: counted, but must not become "last"
+    rollups.add("dev1", "t1", "open", 1_001, 1.0, 0.5, out)
+    assert rollups.sweep(out, idle=False) == 1
+    line = out.decode()
+    assert ",valve_state=closed " in line
+    assert "pressure_now=9" in line and "pressure_prev=8" in line
+    assert "count=3i" in line and "pressure_min=1" in line
+
+
+def test_valve_event_string_field_stays_on_one_line():
+    valves = listener.ValveTracker()
+    out = bytearray()
+    valves.add("dev1", "t1", 'op"en\nx', 1_000, 1.0, 0.5, out)
+    assert valves.add("dev1", "t1", "closed", 2_000, 2.0, 1.0, out) == 1
+    assert out.count(b"\n") == 1
+    assert b'from_state="op\\"en\\nx"' in out
+
+
+# -------- Dedup --------
+def test_dedup_counts_live_in_lru_entry():
+    dedup = listener.DedupIndex(window=8, max_devices=2)
+    recs = [{"device_id": "a", "ts_ms": 1}, {"device_id": "a", "ts_ms": 1}, {"device_id": "b", "ts_ms": 1}]
+    assert len(dedup.filter(recs)) == 2
+    assert dedup.duplicates("a") == 1 and dedup.duplicates("b") == 0
+    # "c" evicts "a" together with its count
+    dedup.filter([{"device_id": "c", "ts_ms": 1}])
+    assert dedup.duplicates("a") == 0
+    assert dedup.snapshot()["devices"] == 2
+
+
+def test_open_rollup_windows_written_on_shutdown(group_listener, monkeypatch):
+    monkeypatch.setattr(listener, "ROLLUP_WINDOWS", "1s,1m")
+    FakeMqttClient.inbox = [("sensors/dev1/status", b'{"team": "t1", "valve_state": "open", "pressure_now": 1.5}')]
+    listener.main()
+    lines = FakeInflux.last.api.lines
+    assert sum(line.startswith(b"device_status_1s,") for line in lines) == 1
+    assert sum(line.startswith(b"device_status_1m,") for line in lines) == 1
+
+
+def test_rollup_window_is_not_reopened_after_sweep():
+    rollups = listener.Rollups(windows=[("10s", 10_000)])
+    out = bytearray()
+    for ts in (1_001, 1_002, 1_003):
+        rollups.add("dev1", "t1", "open", ts, 1.0, 0.5, out)
+    assert rollups.sweep(out, idle=False) == 1
+    # buffered sample of the already written window: counted as late, not written again
+    assert rollups.add("dev1", "t1", "open", 1_004, 9.0, 0.5, out) == 0
+    assert rollups.sweep(out, idle=False) == 0
+    assert out.count(b"\n") == 1 and b"count=3i" in out
+    assert rollups.snapshot()["late"] == 1
+
+
+# -------- status.bin --------
+def test_status_bin_team():
+    v1 = listener.encode_status_bin([(1_000, 1.5, 1.0, "open")])
+    v2 = listener.encode_status_bin([(1_000, 1.5, 1.0, "open")], team="t1")
+    assert listener.decode_status_bin("dev1", v1)[0]["team"] is None
+    assert listener.decode_status_bin("dev1", v1, "t0")[0]["team"] == "t0"
+    # v2 header wins over the registry
+    rec = listener.decode_status_bin("dev1", v2, "t0")[0]
+    assert rec["team"] == "t1" and rec["pressure_now"] == 1.5 and rec["valve_state"] == "open"
+    assert listener.decode_status_bin("dev1", v2[:3]) is None
+
+
+def test_status_bin_without_team_is_skipped(group_listener, monkeypatch):
+    monkeypatch.setattr(listener, "DEFAULT_TEAM", "")
+    FakeMqttClient.inbox = [
+        ("sensors/dev1/status.bin", listener.encode_status_bin([(1_000, 1.5, 1.0, "open")])),
+        ("sensors/dev2/status.bin", listener.encode_status_bin([(1_000, 2.5, 1.0, "open")], team="t1")),
+    ]
+    listener.main()
+    lines = [line for line in FakeInflux.last.api.lines if line.startswith(b"device_status,")]
+    assert len(lines) == 1 and b"device_id=dev2" in lines[0] and b"team=t1" in lines[0]
+    devices = json.loads((group_listener / "devices.node-a.json").read_text(encoding="utf-8"))
+    assert devices["dev1"]["bin_no_team"] == 1 and "team" not in devices["dev1"]
+
+
+def test_rejected_segments_count_toward_spool_cap(tmp_path):
+    spool = listener.Spool(tmp_path, segment_bytes=10, max_bytes=40)
+    spool.reject_data(b"m bad 1\nm bad 2\n", 2)   # 16 bytes
+    spool.append(b"m v=1 10\nm v=2 20\n", 2)      # 18 bytes, closes a segment
+    assert len(list(tmp_path.glob("seg-*.bad"))) == 1
+    spool.append(b"m v=3 30\n", 1)                # 43 > 40: the .bad goes first
+    assert list(tmp_path.glob("seg-*.bad")) == []
+    assert spool.pending_bytes() == 27
+    # reopened spool picks the .bad files up again
+    spool.reject_data(b"m bad 4\n", 1)
+    spool.close()
+    assert listener.Spool(tmp_path, max_bytes=40).bad_bytes == 8